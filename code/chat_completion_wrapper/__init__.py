@@ -1,4 +1,39 @@
-from .base_chat_completion_wrapper import ChatMessage, LoadingModelError, DisabledEndpointError, AuthenticationError
+from .base_chat_completion_wrapper import (
+    ChatMessage,
+    LoadingModelError,
+    DisabledEndpointError,
+    AuthenticationError,
+    CacheMissError,
+    consume_stream,
+    aconsume_stream,
+    get_cache_params,
+    ANSWER_CHOICES,
+    get_choice_probabilities,
+    sample_concurrently,
+    asample_concurrently,
+)
+from .response_cache import ResponseCache
+from .request_coalescer import RequestCoalescer
+from .http_transport import HTTPTransport, configure_http_transport, get_http_transport
+from .token_counter import (
+    TokenCounter,
+    ApproximateTokenCounter,
+    load_tiktoken,
+    load_tokenizer_json,
+    configure_token_counter,
+    get_token_counter,
+)
+from .rate_limiter import RateLimiter, OPENAI_RATE_LIMITS, configure_rate_limit, get_rate_limiter
+from .metrics import (
+    RequestMetrics,
+    MetricsRecorder,
+    metric_labels,
+    track_request,
+    configure_price,
+    get_metrics_recorder,
+)
+from .hedging import HedgingPolicy, configure_hedging, get_hedging_policy
+from .hf_endpoint_manager import HFEndpointManager
 from .openai_chat_completion_wrapper import OpenAIChatCompletionWrapper
 from .hf_chat_completion_wrapper import HFLlama2ChatCompletionWrapper, HFFalconChatCompletionWrapper
 from .maritalk_chat_completion_wrapper import MariTalkChatCompletionWrapper
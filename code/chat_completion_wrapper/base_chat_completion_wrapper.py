@@ -1,5 +1,13 @@
+import math
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Literal
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Literal
+from .metrics import RequestMetrics
+
+# the letters of the alternatives, scored by score_choices
+ANSWER_CHOICES = ("A", "B", "C", "D", "E")
 
 
 class LoadingModelError(Exception):
@@ -14,6 +22,10 @@ class AuthenticationError(Exception):
     pass
 
 
+class CacheMissError(Exception):
+    pass
+
+
 @dataclass  # slots?
 class ChatMessage:
     role: Literal["system", "assistant", "user"]
@@ -33,6 +45,92 @@ class ChatMessage:
         #     raise ValueError("Age must be between 0 and 150")
 
 
+def consume_stream(
+    chunks: Iterator[str],
+    stop_when: Callable[[str], bool] | None = None,
+    on_text: Callable[[str], None] | None = None,
+) -> str:
+    """joins the streamed text. As soon as stop_when(text) is true, the stream is closed, cancelling the request.
+    on_text(text) is called with the text so far after each chunk"""
+    text = ""
+    try:
+        for chunk in chunks:
+            text += chunk
+            if on_text is not None and chunk != "":
+                on_text(text)
+            if stop_when is not None and stop_when(text):
+                break
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return text
+
+
+async def aconsume_stream(
+    chunks: AsyncIterator[str],
+    stop_when: Callable[[str], bool] | None = None,
+    on_text: Callable[[str], None] | None = None,
+) -> str:
+    text = ""
+    try:
+        async for chunk in chunks:
+            text += chunk
+            if on_text is not None and chunk != "":
+                on_text(text)
+            if stop_when is not None and stop_when(text):
+                break
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+    return text
+
+
+def sample_concurrently(send: Callable[[RequestMetrics], str], n: int, metrics: RequestMetrics) -> list[str]:
+    """n answers from a provider without a parameter for several answers per request: send(metrics) is called n times
+    in threads (in the context of the caller, e.g., its log session), each request is measured apart and added to the
+    metrics of the call"""
+    samples_metrics = [metrics.fork() for _ in range(n)]
+    try:
+        with ThreadPoolExecutor(max_workers=n, thread_name_prefix="sample") as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, send, sample_metrics)
+                for sample_metrics in samples_metrics
+            ]
+            return [future.result() for future in futures]
+    finally:
+        for sample_metrics in samples_metrics:
+            metrics.add(sample_metrics)
+
+
+async def asample_concurrently(
+    send: Callable[[RequestMetrics], Awaitable[str]], n: int, metrics: RequestMetrics
+) -> list[str]:
+    samples_metrics = [metrics.fork() for _ in range(n)]
+    try:
+        return list(await asyncio.gather(*[send(sample_metrics) for sample_metrics in samples_metrics]))
+    finally:
+        for sample_metrics in samples_metrics:
+            metrics.add(sample_metrics)
+
+
+def get_choice_probabilities(choice_logprobs: dict[str, float | None]) -> dict[str, float]:
+    """the log probabilities of the choices normalized into a distribution over them (0 for a choice without one)"""
+    known = {choice: logprob for choice, logprob in choice_logprobs.items() if logprob is not None}
+    if len(known) == 0:
+        return dict.fromkeys(choice_logprobs, 0.0)
+    max_logprob = max(known.values())
+    weights = {choice: math.exp(logprob - max_logprob) for choice, logprob in known.items()}
+    total = sum(weights.values())
+    return {choice: weights.get(choice, 0.0) / total for choice in choice_logprobs}
+
+
+def get_cache_params(params: dict, stop_when: Callable[[str], bool] | None) -> dict:
+    """an early stopped completion is not the same as the full one, so it is cached under another key"""
+    if stop_when is None:
+        return params
+    return dict(params, stop_when=getattr(stop_when, "__name__", repr(stop_when)))
+
+
 # if __name__ == "__main__":
 #     ChatMessage(role=Role.User, content="asdasd")
 #     assert "user" == Role("user") == Role.User == Role(Role.User)
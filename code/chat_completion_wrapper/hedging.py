@@ -0,0 +1,193 @@
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Awaitable, Callable
+from chat_completion_wrapper.metrics import RequestMetrics, get_quantile
+
+
+class HedgingPolicy:
+    """Sends a duplicate of a request that takes longer than usual, and takes the answer that arrives first.
+
+    The delay before the duplicate is a quantile of the latencies of the last requests (e.g., the p95), so only
+    the slowest requests are hedged. With temperature=0 both answers are interchangeable. The duplicates are capped
+    to a fraction of the requests, so a slow provider can't double the spend. The tokens of the losing request are
+    not counted in the metrics.
+
+    Args:
+        quantile (float): quantile of the recent latencies after which the duplicate is sent. Defaults to 0.95.
+        window (int): number of recent latencies kept. Defaults to 200.
+        min_samples (int): latencies needed before hedging. Defaults to 20.
+        min_delay (float): minimum seconds before the duplicate. Defaults to 1.
+        max_hedge_ratio (float): maximum fraction of the requests that are duplicated. Defaults to 0.05.
+        max_workers (int): threads running the blocking requests. Defaults to 64.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        window: int = 200,
+        min_samples: int = 20,
+        min_delay: float = 1,
+        max_hedge_ratio: float = 0.05,
+        max_workers: int = 64,
+    ) -> None:
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedging")
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def get_delay(self) -> float | None:
+        """seconds to wait before sending the duplicate, None while there are not enough latencies"""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = list(self.latencies)
+        return max(self.min_delay, get_quantile(latencies, self.quantile))
+
+    def _start(self) -> float | None:
+        with self.lock:
+            self.requests += 1
+        return self.get_delay()
+
+    def _acquire_hedge(self) -> bool:
+        with self.lock:
+            if self.hedged + 1 > self.max_hedge_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def _adopt(self, metrics: RequestMetrics, request_metrics: RequestMetrics, hedge_won: bool = False) -> None:
+        """adds the measurements of the request that answered (or failed last) to the metrics of the call. Each
+        request has its own forked metrics, so the losing one, which may still be running, can't change them"""
+        if hedge_won:
+            with self.lock:
+                self.hedge_wins += 1
+            metrics.hedge_won = True
+        metrics.add(request_metrics)
+        metrics.truncated = request_metrics.truncated
+        if metrics.time_to_first_token is None:
+            metrics.time_to_first_token = request_metrics.time_to_first_token
+
+    def _record(self, started_at: float) -> None:
+        with self.lock:
+            self.latencies.append(time.perf_counter() - started_at)
+
+    def _timed(self, send: Callable[[RequestMetrics], str], metrics: RequestMetrics) -> str:
+        started_at = time.perf_counter()
+        response = send(metrics)
+        self._record(started_at)
+        return response
+
+    async def _atimed(self, send: Callable[[RequestMetrics], Awaitable[str]], metrics: RequestMetrics) -> str:
+        started_at = time.perf_counter()
+        response = await send(metrics)
+        self._record(started_at)
+        return response
+
+    @staticmethod
+    def _fork(metrics: RequestMetrics) -> RequestMetrics:
+        metrics.hedged = True
+        return metrics.fork()
+
+    def call(self, send: Callable[[RequestMetrics], str], metrics: RequestMetrics) -> str:
+        """send(metrics) makes the request. The losing request can't be interrupted, it ends in the background"""
+        delay = self._start()
+        if delay is None:
+            return self._timed(send, metrics)
+
+        # the requests run in the context of the caller, e.g., its log session
+        primary_metrics = metrics.fork()
+        primary = self.executor.submit(contextvars.copy_context().run, self._timed, send, primary_metrics)
+        done, _ = wait([primary], timeout=delay)
+        if len(done) > 0 or not self._acquire_hedge():
+            wait([primary])
+            self._adopt(metrics, primary_metrics)
+            return primary.result()
+
+        hedge_metrics = self._fork(metrics)
+        hedge = self.executor.submit(contextvars.copy_context().run, self._timed, send, hedge_metrics)
+        pending = {primary, hedge}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._adopt(metrics, hedge_metrics, hedge_won=True)
+                    else:
+                        self._adopt(metrics, primary_metrics)
+                    return future.result()
+        self._adopt(metrics, primary_metrics)
+        return primary.result()  # both failed, raises the error of the original request
+
+    async def acall(self, send: Callable[[RequestMetrics], Awaitable[str]], metrics: RequestMetrics) -> str:
+        """async version of call, the losing request is cancelled"""
+        delay = self._start()
+        if delay is None:
+            return await self._atimed(send, metrics)
+
+        primary_metrics = metrics.fork()
+        primary = asyncio.ensure_future(self._atimed(send, primary_metrics))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if len(done) > 0 or not self._acquire_hedge():
+                await asyncio.wait(tasks)
+                self._adopt(metrics, primary_metrics)
+                return primary.result()
+
+            hedge_metrics = self._fork(metrics)
+            hedge = asyncio.ensure_future(self._atimed(send, hedge_metrics))
+            tasks.add(hedge)
+            pending = set(tasks)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._adopt(metrics, hedge_metrics, hedge_won=True)
+                        else:
+                            self._adopt(metrics, primary_metrics)
+                        return task.result()
+            self._adopt(metrics, primary_metrics)
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()  # closing the connection cancels the generation
+
+
+_hedging_policies: dict[tuple[str, str], HedgingPolicy] = {}
+_hedging_configs: dict[tuple[str, str], dict] = {}
+_lock = threading.Lock()
+
+
+def configure_hedging(provider: str, model: str, **kwargs) -> None:
+    """enables hedging for a provider and model (or model prefix), see HedgingPolicy for the arguments.
+    Call it before creating the wrappers"""
+    with _lock:
+        _hedging_configs[(provider, model)] = kwargs
+        for key in list(_hedging_policies.keys()):
+            if key[0] == provider and key[1].startswith(model):
+                del _hedging_policies[key]
+
+
+def get_hedging_policy(provider: str, model: str) -> HedgingPolicy | None:
+    """the same policy (and latencies) is shared by every wrapper instance of a provider and model in this process,
+    None if hedging was not configured for it"""
+    with _lock:
+        if (provider, model) not in _hedging_policies:
+            prefixes = [prefix for (p, prefix) in _hedging_configs if p == provider and model.startswith(prefix)]
+            if len(prefixes) == 0:
+                return None
+            _hedging_policies[(provider, model)] = HedgingPolicy(**_hedging_configs[(provider, max(prefixes, key=len))])
+        return _hedging_policies[(provider, model)]
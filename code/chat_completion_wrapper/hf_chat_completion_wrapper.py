@@ -1,10 +1,32 @@
-from chat_completion_wrapper import ChatMessage, LoadingModelError, DisabledEndpointError
-import requests
+from chat_completion_wrapper import (
+    ChatMessage,
+    ResponseCache,
+    get_rate_limiter,
+    consume_stream,
+    aconsume_stream,
+    get_cache_params,
+    ANSWER_CHOICES,
+    sample_concurrently,
+    asample_concurrently,
+    configure_token_counter,
+    get_token_counter,
+    load_tokenizer_json,
+    HTTPTransport,
+    get_http_transport,
+    ApproximateTokenCounter,
+    RequestMetrics,
+    track_request,
+    get_hedging_policy,
+)
+from chat_completion_wrapper.rate_limiter import estimate_tokens
+from chat_completion_wrapper.hf_endpoint_manager import HFEndpointManager
 from logger import logger
-from huggingface_hub import InferenceClient
+from huggingface_hub import InferenceClient, AsyncInferenceClient
 from huggingface_hub.inference._text_generation import FinishReason
+import json
+import asyncio
 import dataclasses
-from typing import Callable
+from typing import AsyncIterator, Callable, Iterator, Sequence
 
 # resources to keep eyes on
 # https://huggingface.co/blog/llama2#how-to-prompt-llama-2
@@ -20,17 +42,47 @@ You are a helpful, respectful and honest assistant. Always answer as helpfully a
 
 If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information."""
 
+# TGI returns the log probability of each prompt token with decoder_input_details, see score_choices
+SCORE_PARAMS = dict(max_new_tokens=1, details=True, decoder_input_details=True)
+
 
 class _HFChatCompletionWrapper:
-    def __init__(self, endpoint_url: str, token: str, namespace: str, name: str, log: bool = True) -> None:
+    def __init__(
+        self,
+        endpoint_url: str,
+        token: str,
+        namespace: str,
+        name: str,
+        log: bool = True,
+        cache: ResponseCache | None = None,
+        tokenizer_path: str | None = None,
+        http_transport: HTTPTransport | None = None,
+    ) -> None:
         self.context_length = None  # should be the same in the container configuration inside the HF endpoint settings
         self.log = log
         self.namespace = namespace
         self.name = name
         self.token = token
+        self.cache = cache
+        self.rate_limiter = get_rate_limiter("huggingface", name)
+        if tokenizer_path is not None:
+            # tokenizer.json of the model, otherwise the tokens are approximated from the number of characters
+            configure_token_counter("huggingface", name, load_tokenizer_json(tokenizer_path))
+        self.token_counter = get_token_counter("huggingface", name)
+        self.hedging = get_hedging_policy("huggingface", name)  # None unless configured
+
+        # InferenceClient uses the sessions of the shared transport (see get_http_transport), this one sets the
+        # timeouts
+        self.http_transport = get_http_transport() if http_transport is None else http_transport
 
         # Streaming Client
-        self.client = InferenceClient(endpoint_url, self.token)
+        self.client = InferenceClient(endpoint_url, self.token, timeout=self.http_transport.read_timeout)
+        # AsyncInferenceClient opens its own aiohttp session for each request, it can't be shared
+        self.async_client = AsyncInferenceClient(endpoint_url, self.token, timeout=self.http_transport.read_timeout)
+        # the requests wait while the endpoint is starting (e.g., scaled to zero) instead of failing
+        self.endpoint_manager = HFEndpointManager(
+            endpoint_url, token, namespace, name, session=self.http_transport.new_session()
+        )
 
         # generation parameter
         self._default_generation_params = None
@@ -77,36 +129,89 @@ class _HFChatCompletionWrapper:
         # print(params)
         return params
 
-    def _check_endpoint_status(self) -> tuple[int, str]:
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-        }
-
-        response = requests.get(
-            f"https://api.endpoints.huggingface.cloud/v2/endpoint/{self.namespace}/{self.name}", headers=headers
-        )
-
-        return response.status_code, None if response.status_code != 200 else response.json()["status"]["state"]
-
-    def __call__(self, message: str, post_process: Callable[[str], str] | None = None, **kwargs) -> str:
-        self.messages.append(ChatMessage(role="user", content=message))
-        if self.log:
-            logger(content=self.messages[-1])
-
-        params = self._kwargs_to_generation_params(kwargs)
-        formatted_messages: str = self._format_messages(self.messages)
+    def _prepare_request(self, messages: list[ChatMessage], params: dict) -> tuple[str, dict]:
+        formatted_messages: str = self._format_messages(list(messages))  # copy, _format_messages may insert the system message
+        token_budget = params.pop("token_budget", None)  # see _request_within_budget
 
         if "max_new_tokens" in params:
-            formatted_messages_tokens_length = int(
-                len(formatted_messages) // 2.5
-            )  # approximation, see: https://github.com/philschmid/easyllm/blob/2603d0dc5e3950ea5e645036045f8cc6a46608d0/easyllm/clients/huggingface.py#L176C9-L176C9
+            formatted_messages_tokens_length = self.token_counter.count(formatted_messages)
             # print("formatted_messages_tokens_length", formatted_messages_tokens_length)
             # print("params[max_new_tokens]", params["max_new_tokens"])
             if formatted_messages_tokens_length > params["max_new_tokens"]:
                 params["max_new_tokens"] = self.context_length - formatted_messages_tokens_length  # max possible value
                 # print("updated params[max_new_tokens]", params["max_new_tokens"])
+            # the prompt and the completion must fit in the context
+            params["max_new_tokens"] = min(params["max_new_tokens"], self.context_length - formatted_messages_tokens_length)
             assert params["max_new_tokens"] > 0
+            if token_budget is not None:
+                # after the max possible value above, which would undo the budget of a long prompt
+                params["max_new_tokens"] = min(params["max_new_tokens"], token_budget)
+
+        return formatted_messages, params
+
+    def _process_response(self, response, metrics: RequestMetrics) -> str:
+        if type(response) is str:
+            # TODO temporary to handle gpt4all
+            generated_text = response
+        else:
+            metrics.completion_tokens += response.details.generated_tokens
+            metrics.truncated = response.details.finish_reason == FinishReason.Length
+            generated_text = response.generated_text
+            if response.details.finish_reason == FinishReason.StopSequence:
+                generated_text = generated_text.removesuffix(response.details.tokens[-1].text)
+
+        return generated_text.strip()
+
+    def _stream_chunks(self, formatted_messages: str, params: dict, metrics: RequestMetrics) -> Iterator[str]:
+        stream = self.client.text_generation(formatted_messages, stream=True, details=True, **params)
+        try:
+            for response in stream:
+                metrics.first_token()
+                metrics.completion_tokens += 1
+                if response.details is not None:
+                    metrics.truncated = response.details.finish_reason == FinishReason.Length
+                if response.token.special:
+                    continue
+                if response.details is not None and response.details.finish_reason == FinishReason.StopSequence:
+                    continue  # the last token is the stop sequence, as in _process_response
+                yield response.token.text
+        finally:
+            stream.close()  # closing the stream early drops the connection, cancelling the generation
+
+    async def _astream_chunks(
+        self, formatted_messages: str, params: dict, metrics: RequestMetrics
+    ) -> AsyncIterator[str]:
+        stream = await self.async_client.text_generation(formatted_messages, stream=True, details=True, **params)
+        try:
+            async for response in stream:
+                metrics.first_token()
+                metrics.completion_tokens += 1
+                if response.details is not None:
+                    metrics.truncated = response.details.finish_reason == FinishReason.Length
+                if response.token.special:
+                    continue
+                if response.details is not None and response.details.finish_reason == FinishReason.StopSequence:
+                    continue
+                yield response.token.text
+        finally:
+            await stream.aclose()
+
+    def _count_prompt_tokens(self, formatted_messages: str, metrics: RequestMetrics) -> None:
+        metrics.prompt_tokens += self.token_counter.count(formatted_messages)
+        metrics.estimated_tokens = isinstance(self.token_counter, ApproximateTokenCounter)
+
+    def _send(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        formatted_messages, params = self._prepare_request(messages, params)
+        self._count_prompt_tokens(formatted_messages, metrics)
+        metrics.truncated = False
 
         # Previous attempt
         # https://github.com/huggingface/huggingface_hub/issues/1605#issuecomment-1684105783
@@ -121,27 +226,307 @@ class _HFChatCompletionWrapper:
         #     logger(content="UnknownEndpointError")
         #     raise UnknownEndpointError from e
 
-        try:
-            response = self.client.text_generation(formatted_messages, stream=False, details=True, **params)
-        except Exception as e:
-            status_code, endpoint_state = self._check_endpoint_status()
-            if status_code == 200:
-                # pending, initializing, updating, updateFailed, running, paused, failed, scaledToZero
-                if endpoint_state == "paused":
-                    raise DisabledEndpointError from e
-                elif endpoint_state in ["scaledToZero", "initializing", "updating"]:
-                    raise LoadingModelError from e
-            raise
+        self.rate_limiter.acquire(
+            estimate_tokens(formatted_messages, params.get("max_new_tokens", 0), self.token_counter)
+        )
+        while True:
+            self.endpoint_manager.wait_until_running()
+            metrics.attempts += 1
+            try:
+                if stream or stop_when is not None or on_text is not None:
+                    return consume_stream(self._stream_chunks(formatted_messages, params, metrics), stop_when, on_text).strip()
+                response = self.client.text_generation(formatted_messages, stream=False, details=True, **params)
+                return self._process_response(response, metrics)
+            except Exception as e:
+                # the endpoint may have been scaled to zero in the meantime
+                if not self.endpoint_manager.should_retry(e):
+                    raise
+
+    async def _asend(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        formatted_messages, params = self._prepare_request(messages, params)
+        self._count_prompt_tokens(formatted_messages, metrics)
+        metrics.truncated = False
+
+        await self.rate_limiter.aacquire(
+            estimate_tokens(formatted_messages, params.get("max_new_tokens", 0), self.token_counter)
+        )
+        while True:
+            await self.endpoint_manager.await_until_running()
+            metrics.attempts += 1
+            try:
+                if stream or stop_when is not None or on_text is not None:
+                    chunks = self._astream_chunks(formatted_messages, params, metrics)
+                    return (await aconsume_stream(chunks, stop_when, on_text)).strip()
+                response = await self.async_client.text_generation(
+                    formatted_messages, stream=False, details=True, **params
+                )
+                return self._process_response(response, metrics)
+            except Exception as e:
+                if not await asyncio.to_thread(self.endpoint_manager.should_retry, e):
+                    raise
+
+    def _request(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        if self.hedging is None or on_text is not None:  # on_text would get the text of both requests
+            return self._send(messages, params, stream, stop_when, on_text, metrics)
+        return self.hedging.call(lambda m: self._send(messages, dict(params), stream, stop_when, None, m), metrics)
+
+    async def _arequest(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        if self.hedging is None or on_text is not None:
+            return await self._asend(messages, params, stream, stop_when, on_text, metrics)
+        return await self.hedging.acall(
+            lambda m: self._asend(messages, dict(params), stream, stop_when, None, m), metrics
+        )
 
-        if type(response) is str:
-            # TODO temporary to handle gpt4all
-            generated_text = response
-        else:
-            generated_text = response.generated_text
-            if response.details.finish_reason == FinishReason.StopSequence:
-                generated_text = generated_text.removesuffix(response.details.tokens[-1].text)
+    def _request_within_budget(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        token_budget: int | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        """see OpenAIChatCompletionWrapper._request_within_budget"""
+        if token_budget is None or token_budget >= params["max_new_tokens"]:
+            return self._request(messages, params, stream, stop_when, on_text, metrics)
+        result = self._request(messages, dict(params, token_budget=token_budget), stream, stop_when, on_text, metrics)
+        if not metrics.truncated:
+            return result
+        metrics.budget_retries += 1
+        return self._request(messages, dict(params), stream, stop_when, on_text, metrics)
+
+    async def _arequest_within_budget(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        token_budget: int | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        if token_budget is None or token_budget >= params["max_new_tokens"]:
+            return await self._arequest(messages, params, stream, stop_when, on_text, metrics)
+        budget_params = dict(params, token_budget=token_budget)
+        result = await self._arequest(messages, budget_params, stream, stop_when, on_text, metrics)
+        if not metrics.truncated:
+            return result
+        metrics.budget_retries += 1
+        return await self._arequest(messages, dict(params), stream, stop_when, on_text, metrics)
+
+    def _complete(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+    ) -> str:
+        """stateless completion, it does not touch self.messages"""
+        with track_request("huggingface", self.name) as metrics:
+            if self.cache is None:
+                return self._request_within_budget(messages, params, stream, stop_when, on_text, token_budget, metrics)
+            return self.cache.get_or_complete(
+                f"{self.namespace}/{self.name}",
+                get_cache_params(params, stop_when),
+                messages,
+                lambda: self._request_within_budget(
+                    messages, dict(params), stream, stop_when, on_text, token_budget, metrics
+                ),
+            )
+
+    async def _acomplete(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+    ) -> str:
+        with track_request("huggingface", self.name) as metrics:
+            if self.cache is None:
+                return await self._arequest_within_budget(
+                    messages, params, stream, stop_when, on_text, token_budget, metrics
+                )
+            return await self.cache.aget_or_complete(
+                f"{self.namespace}/{self.name}",
+                get_cache_params(params, stop_when),
+                messages,
+                lambda: self._arequest_within_budget(
+                    messages, dict(params), stream, stop_when, on_text, token_budget, metrics
+                ),
+            )
+
+    def _get_continuation(self, formatted_messages: str, choice: str) -> str:
+        """the prompt followed by the choice, as the model would start the answer"""
+        separator = "" if formatted_messages.endswith(" ") else " "
+        return formatted_messages + separator + choice
+
+    def _score_choice(self, formatted_messages: str, choice: str, metrics: RequestMetrics) -> float | None:
+        prompt = self._get_continuation(formatted_messages, choice)
+        self.rate_limiter.acquire(estimate_tokens(prompt, 1, self.token_counter))
+        while True:
+            self.endpoint_manager.wait_until_running()
+            metrics.attempts += 1
+            try:
+                response = self.client.text_generation(prompt, stream=False, **SCORE_PARAMS)
+                metrics.completion_tokens += response.details.generated_tokens
+                return response.details.prefill[-1].logprob  # the last prompt token is the choice
+            except Exception as e:
+                if not self.endpoint_manager.should_retry(e):
+                    raise
+
+    async def _ascore_choice(self, formatted_messages: str, choice: str, metrics: RequestMetrics) -> float | None:
+        prompt = self._get_continuation(formatted_messages, choice)
+        await self.rate_limiter.aacquire(estimate_tokens(prompt, 1, self.token_counter))
+        while True:
+            await self.endpoint_manager.await_until_running()
+            metrics.attempts += 1
+            try:
+                response = await self.async_client.text_generation(prompt, stream=False, **SCORE_PARAMS)
+                metrics.completion_tokens += response.details.generated_tokens
+                return response.details.prefill[-1].logprob
+            except Exception as e:
+                if not await asyncio.to_thread(self.endpoint_manager.should_retry, e):
+                    raise
+
+    def _score(
+        self, messages: list[ChatMessage], choices: Sequence[str], metrics: RequestMetrics
+    ) -> dict[str, float | None]:
+        formatted_messages = self._format_messages(list(messages))
+        self._count_prompt_tokens(formatted_messages, metrics)
+        metrics.prompt_tokens *= len(choices)  # the prompt is sent once per choice
+        return {choice: self._score_choice(formatted_messages, choice, metrics) for choice in choices}
+
+    async def _ascore(
+        self, messages: list[ChatMessage], choices: Sequence[str], metrics: RequestMetrics
+    ) -> dict[str, float | None]:
+        formatted_messages = self._format_messages(list(messages))
+        self._count_prompt_tokens(formatted_messages, metrics)
+        metrics.prompt_tokens *= len(choices)
+        logprobs = await asyncio.gather(
+            *[self._ascore_choice(formatted_messages, choice, metrics) for choice in choices]
+        )
+        return dict(zip(choices, logprobs))
+
+    def score_choices(self, message: str, choices: Sequence[str] = ANSWER_CHOICES) -> dict[str, float | None]:
+        """see OpenAIChatCompletionWrapper.score_choices. TGI has no top tokens of the first output token, so each
+        choice is appended to the prompt and its log probability is read from the prompt details, one request of a
+        single output token per choice (the answers are equivalent, the prompt is prefilled once per choice)"""
+        messages = [ChatMessage(role="user", content=message)]
+        with track_request("huggingface", self.name) as metrics:
+            if self.cache is None:
+                return self._score(messages, choices, metrics)
+            return json.loads(
+                self.cache.get_or_complete(
+                    f"{self.namespace}/{self.name}",
+                    dict(SCORE_PARAMS, choices=list(choices)),
+                    messages,
+                    lambda: json.dumps(self._score(messages, choices, metrics)),
+                )
+            )
+
+    async def ascore_choices(self, message: str, choices: Sequence[str] = ANSWER_CHOICES) -> dict[str, float | None]:
+        """async version of score_choices, the choices are scored concurrently"""
+        messages = [ChatMessage(role="user", content=message)]
+        with track_request("huggingface", self.name) as metrics:
+            if self.cache is None:
+                return await self._ascore(messages, choices, metrics)
+
+            async def score() -> str:
+                return json.dumps(await self._ascore(messages, choices, metrics))
+
+            return json.loads(
+                await self.cache.aget_or_complete(
+                    f"{self.namespace}/{self.name}", dict(SCORE_PARAMS, choices=list(choices)), messages, score
+                )
+            )
+
+    def sample(self, message: str, n: int, system_content: str | None = None, **kwargs) -> list[str]:
+        """see OpenAIChatCompletionWrapper.sample. TGI returns a single answer per request, so n requests are sent
+        concurrently"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        params = self._kwargs_to_generation_params(kwargs)
 
-        result = generated_text.strip()
+        def sample() -> str:
+            return json.dumps(
+                sample_concurrently(lambda m: self._request(messages, dict(params), False, None, None, m), n, metrics)
+            )
+
+        with track_request("huggingface", self.name) as metrics:
+            if self.cache is None:
+                return json.loads(sample())
+            return json.loads(
+                self.cache.get_or_complete(f"{self.namespace}/{self.name}", dict(params, n=n), messages, sample)
+            )
+
+    async def asample(self, message: str, n: int, system_content: str | None = None, **kwargs) -> list[str]:
+        """async version of sample"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        params = self._kwargs_to_generation_params(kwargs)
+
+        async def sample() -> str:
+            return json.dumps(
+                await asample_concurrently(
+                    lambda m: self._arequest(messages, dict(params), False, None, None, m), n, metrics
+                )
+            )
+
+        with track_request("huggingface", self.name) as metrics:
+            if self.cache is None:
+                return json.loads(await sample())
+            return json.loads(
+                await self.cache.aget_or_complete(f"{self.namespace}/{self.name}", dict(params, n=n), messages, sample)
+            )
+
+    def __call__(
+        self,
+        message: str,
+        post_process: Callable[[str], str] | None = None,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+        **kwargs,
+    ) -> str:
+        """see OpenAIChatCompletionWrapper.__call__"""
+        self.messages.append(ChatMessage(role="user", content=message))
+        if self.log:
+            logger(content=self.messages[-1])
+
+        params = self._kwargs_to_generation_params(kwargs)
+        result = self._complete(
+            self.messages, params, stream=stream, stop_when=stop_when, on_text=on_text, token_budget=token_budget
+        )
 
         if post_process is not None:
             if self.log:
@@ -154,10 +539,63 @@ class _HFChatCompletionWrapper:
 
         return result
 
+    async def acall(
+        self,
+        message: str,
+        post_process: Callable[[str], str] | None = None,
+        system_content: str | None = None,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+        **kwargs,
+    ) -> str:
+        """async version of __call__. Each call is a single-turn session of its own (self.messages is not used),
+        so many calls can be in flight at the same time"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        if self.log:
+            for msg in messages:
+                logger(content=msg)
+
+        params = self._kwargs_to_generation_params(kwargs)
+        result = await self._acomplete(
+            messages, params, stream=stream, stop_when=stop_when, on_text=on_text, token_budget=token_budget
+        )
+
+        if post_process is not None:
+            if self.log:
+                logger(observation="assistant-before-post-process", content=ChatMessage(role="assistant", content=result))
+            result = post_process(result)
+
+        if self.log:
+            logger(content=ChatMessage(role="assistant", content=result))
+
+        return result
+
 
 class HFLlama2ChatCompletionWrapper(_HFChatCompletionWrapper):
-    def __init__(self, endpoint_url: str, token: str, namespace: str, name: str, log: bool = True) -> None:
-        super().__init__(endpoint_url=endpoint_url, token=token, namespace=namespace, name=name, log=log)
+    def __init__(
+        self,
+        endpoint_url: str,
+        token: str,
+        namespace: str,
+        name: str,
+        log: bool = True,
+        cache: ResponseCache | None = None,
+        tokenizer_path: str | None = None,
+        http_transport: HTTPTransport | None = None,
+    ) -> None:
+        super().__init__(
+            endpoint_url=endpoint_url,
+            token=token,
+            namespace=namespace,
+            name=name,
+            log=log,
+            cache=cache,
+            tokenizer_path=tokenizer_path,
+            http_transport=http_transport,
+        )
         self.context_length = 4096  # should be the same in the container configuration inside the HF endpoint settings
 
         # generation parameter
@@ -204,8 +642,27 @@ class HFLlama2ChatCompletionWrapper(_HFChatCompletionWrapper):
 
 
 class HFFalconChatCompletionWrapper(_HFChatCompletionWrapper):
-    def __init__(self, endpoint_url: str, token: str, namespace: str, name: str, log: bool = True) -> None:
-        super().__init__(endpoint_url=endpoint_url, token=token, namespace=namespace, name=name, log=log)
+    def __init__(
+        self,
+        endpoint_url: str,
+        token: str,
+        namespace: str,
+        name: str,
+        log: bool = True,
+        cache: ResponseCache | None = None,
+        tokenizer_path: str | None = None,
+        http_transport: HTTPTransport | None = None,
+    ) -> None:
+        super().__init__(
+            endpoint_url=endpoint_url,
+            token=token,
+            namespace=namespace,
+            name=name,
+            log=log,
+            cache=cache,
+            tokenizer_path=tokenizer_path,
+            http_transport=http_transport,
+        )
         self.context_length = 4096  # 2048  # should be the same in the container configuration inside the HF endpoint settings
 
         # generation parameter
@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+import threading
+import requests
+from chat_completion_wrapper import LoadingModelError, DisabledEndpointError
+
+# set huggingface_endpoints_api_url to use another API, e.g., a local stub in the tests
+DEFAULT_ENDPOINTS_API_URL = "https://api.endpoints.huggingface.cloud/v2/endpoint"
+
+# pending, initializing, updating, updateFailed, running, paused, failed, scaledToZero
+STARTING_STATES = ["pending", "initializing", "updating", "scaledToZero"]
+DISABLED_STATES = ["paused"]
+
+
+class HFEndpointManager:
+    """Keeps track of the state of a Hugging Face Inference Endpoint, waking it up and waiting until it is running.
+
+    The state is polled from the endpoints API at most once every min_poll_interval seconds, whatever the number
+    of threads or tasks waiting, and the last state is reused for status_ttl seconds. While the endpoint is
+    starting, the requests wait for it (up to wait_timeout) instead of failing.
+
+    Args:
+        endpoint_url (str): url of the endpoint, a request to it wakes up a scaled to zero endpoint.
+        token (str): Hugging Face token.
+        namespace (str): namespace of the endpoint.
+        name (str): name of the endpoint.
+        api_url (str | None): endpoints API. Defaults to None (huggingface_endpoints_api_url or DEFAULT_ENDPOINTS_API_URL).
+        status_ttl (float): seconds during which the last state is reused. Defaults to 30.
+        min_poll_interval (float): minimum seconds between two requests to the endpoints API. Defaults to 5.
+        wait_timeout (float): seconds to wait for the endpoint to be running before raising LoadingModelError. Defaults to 15 min.
+        session (requests.Session | None): session of the requests, e.g., with pooled connections. Defaults to None (a new session).
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        token: str,
+        namespace: str,
+        name: str,
+        api_url: str | None = None,
+        status_ttl: float = 30,
+        min_poll_interval: float = 5,
+        wait_timeout: float = 15 * 60,
+        session: requests.Session | None = None,
+    ) -> None:
+        self.endpoint_url = endpoint_url
+        self.token = token
+        self.namespace = namespace
+        self.name = name
+        if api_url is None:
+            api_url = os.environ.get("huggingface_endpoints_api_url", DEFAULT_ENDPOINTS_API_URL)
+        self.api_url = api_url.rstrip("/")
+        self.status_ttl = status_ttl
+        self.min_poll_interval = min_poll_interval
+        self.wait_timeout = wait_timeout
+        self.session = requests.Session() if session is None else session
+
+        self.lock = threading.Lock()
+        self.status_code: int | None = None
+        self.state: str | None = None
+        self.polled_at = -float("inf")
+        self.woken_at = -float("inf")
+
+    def _get_headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    def _poll_status(self) -> tuple[int, str | None]:
+        try:
+            response = self.session.get(
+                f"{self.api_url}/{self.namespace}/{self.name}", headers=self._get_headers(), timeout=10
+            )
+        except requests.RequestException:
+            return 0, None
+        return response.status_code, None if response.status_code != 200 else response.json()["status"]["state"]
+
+    def get_status(self, refresh: bool = False) -> tuple[int | None, str | None]:
+        """returns the status code of the endpoints API and the endpoint state (None if unknown)
+
+        Args:
+            refresh (bool): ignore status_ttl, e.g., after a failed request. Still limited by min_poll_interval.
+        """
+        with self.lock:  # the other threads wait for the ongoing poll and reuse its result
+            elapsed = time.monotonic() - self.polled_at
+            if elapsed >= self.status_ttl or (refresh and elapsed >= self.min_poll_interval):
+                self.status_code, self.state = self._poll_status()
+                self.polled_at = time.monotonic()
+            return self.status_code, self.state
+
+    def wake(self) -> None:
+        """sends a request to a scaled to zero endpoint so it starts, without waiting for it"""
+        status_code, state = self.get_status()
+        if state in DISABLED_STATES:
+            raise DisabledEndpointError(f"The endpoint {self.namespace}/{self.name} is {state}")
+        if state != "scaledToZero":
+            return
+        with self.lock:
+            if time.monotonic() - self.woken_at < self.min_poll_interval:
+                return
+            self.woken_at = time.monotonic()
+        try:
+            # any request wakes it up, the reply is an error until it is running
+            self.session.post(
+                self.endpoint_url,
+                headers=self._get_headers(),
+                json=dict(inputs="", parameters=dict(max_new_tokens=1)),
+                timeout=10,
+            )
+        except requests.RequestException:
+            pass
+
+    def _check_state(self, state: str | None, started_at: float, e: Exception | None = None) -> bool:
+        """returns whether the endpoint is running, raises if it is disabled or if it took too long to start"""
+        if state in DISABLED_STATES:
+            raise DisabledEndpointError(f"The endpoint {self.namespace}/{self.name} is {state}") from e
+        if state not in STARTING_STATES:
+            return True  # running, or unknown (no access to the endpoints API): the request itself tells
+        if time.monotonic() - started_at > self.wait_timeout:
+            raise LoadingModelError(f"The endpoint {self.namespace}/{self.name} is still {state}") from e
+        return False
+
+    def wait_until_running(self) -> None:
+        started_at = time.monotonic()
+        while not self._check_state(self.get_status()[1], started_at):
+            self.wake()
+            time.sleep(self.min_poll_interval)
+
+    async def await_until_running(self) -> None:
+        started_at = time.monotonic()
+        while not self._check_state((await asyncio.to_thread(self.get_status))[1], started_at):
+            await asyncio.to_thread(self.wake)
+            await asyncio.sleep(self.min_poll_interval)
+
+    def should_retry(self, e: Exception) -> bool:
+        """after a failed request: whether the endpoint is starting, so the request should wait and be sent again
+
+        Raises DisabledEndpointError if the endpoint is paused.
+        """
+        status_code, state = self.get_status(refresh=True)
+        if state in DISABLED_STATES:
+            raise DisabledEndpointError(f"The endpoint {self.namespace}/{self.name} is {state}") from e
+        return status_code == 200 and state in STARTING_STATES
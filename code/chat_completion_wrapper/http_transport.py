@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPTransport:
+    """Keep-alive connection pools shared by the chat completion wrappers, so the concurrent requests to a provider
+    reuse the open connections instead of paying a new TLS handshake each time.
+
+    The clients of the providers only accept requests (and aiohttp, for the async OpenAI requests), so the
+    connections are HTTP/1.1, with up to pool_maxsize open connections per host. A requests.Session is not guaranteed
+    to be thread-safe, so each thread gets its own session (see new_session), all mounting the same pools.
+
+    Args:
+        pool_maxsize (int): connections kept open per host, should be at least the concurrency. Defaults to 32.
+        connect_timeout (float): seconds to establish a connection. Defaults to 10.
+        read_timeout (float): seconds to wait for the response. Defaults to 60.
+    """
+
+    def __init__(self, pool_maxsize: int = 32, connect_timeout: float = 10, read_timeout: float = 60) -> None:
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+
+        # an aiohttp session can only be used in the event loop that created it
+        self.aiohttp_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+    def new_session(self) -> requests.Session:
+        """a session for one thread, with the shared connection pools"""
+        session = requests.Session()
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        return session
+
+    async def get_aiohttp_session(self):
+        """the session of the running event loop, None if aiohttp is not installed"""
+        try:
+            import aiohttp
+        except ImportError:
+            return None
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            session = self.aiohttp_sessions.get(loop)
+            if session is None or session.closed:
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit_per_host=self.pool_maxsize),
+                    timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                )
+                self.aiohttp_sessions[loop] = session
+        return session
+
+    async def aclose(self) -> None:
+        """closes the aiohttp session of the running event loop, call it before the loop ends"""
+        with self.lock:
+            session = self.aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+_http_transport: HTTPTransport | None = None
+_lock = threading.Lock()
+
+
+def _use_in_clients(http_transport: HTTPTransport) -> None:
+    """the openai and huggingface_hub clients keep their sessions globally, one per thread, made with the factory"""
+    try:
+        import openai
+
+        openai.requestssession = http_transport.new_session
+    except ImportError:
+        pass
+    try:
+        from huggingface_hub import configure_http_backend
+
+        configure_http_backend(backend_factory=http_transport.new_session)
+    except ImportError:  # huggingface_hub < 0.17 always uses requests directly
+        pass
+
+
+def configure_http_transport(
+    pool_maxsize: int = 32, connect_timeout: float = 10, read_timeout: float = 60
+) -> HTTPTransport:
+    """replaces the shared transport, used by the wrappers created from now on and by the openai and
+    huggingface_hub clients"""
+    global _http_transport
+    with _lock:
+        _http_transport = HTTPTransport(
+            pool_maxsize=pool_maxsize, connect_timeout=connect_timeout, read_timeout=read_timeout
+        )
+        _use_in_clients(_http_transport)
+        return _http_transport
+
+
+def get_http_transport() -> HTTPTransport:
+    """the same transport (and connection pools) is shared by every wrapper in this process"""
+    global _http_transport
+    with _lock:
+        if _http_transport is None:
+            _http_transport = HTTPTransport()
+            _use_in_clients(_http_transport)
+        return _http_transport
@@ -1,16 +1,32 @@
+import json
+import asyncio
 import maritalk
 from typing import Callable
-from chat_completion_wrapper import ChatMessage
+from chat_completion_wrapper import (
+    ChatMessage,
+    ResponseCache,
+    get_rate_limiter,
+    get_token_counter,
+    RequestMetrics,
+    track_request,
+    get_hedging_policy,
+    sample_concurrently,
+)
+from chat_completion_wrapper.rate_limiter import estimate_tokens
 from logger import logger
 import dataclasses
 
 
 class MariTalkChatCompletionWrapper:
-    def __init__(self, log: bool = True) -> None:
+    def __init__(self, log: bool = True, cache: ResponseCache | None = None) -> None:
         self.model = maritalk.MariTalk(
             key="110465859132359652937$80e7f77f3f51e284d2da454306b16ebb589dae350b6e9abe1bbaf0ec66c10356"
         )
         self.log = log
+        self.cache = cache
+        self.rate_limiter = get_rate_limiter("maritalk", "MariTalk")
+        self.token_counter = get_token_counter("maritalk", "MariTalk")
+        self.hedging = get_hedging_policy("maritalk", "MariTalk")  # None unless configured
 
         # generation parameter
         self._default_generation_params = dict(
@@ -49,23 +65,125 @@ class MariTalkChatCompletionWrapper:
 
         return params
 
-    def _chat_completion(self, params: dict = {}) -> dict:
+    def _chat_completion(
+        self, messages: list[ChatMessage], params: dict = {}, metrics: RequestMetrics | None = None
+    ) -> dict:
         """function to call the endpoint, handling possible issues and trying again in case of failure
         It doesn't do any processing
         """
+        self.rate_limiter.acquire(
+            estimate_tokens("".join(msg.content for msg in messages), params.get("max_tokens", 0), self.token_counter)
+        )
+        if metrics is not None:
+            metrics.attempts += 1
         return self.model.generate(
-            messages=[dataclasses.asdict(msg) for msg in self.messages],
+            messages=[dataclasses.asdict(msg) for msg in messages],
             **params,
         )
 
-    def __call__(self, message: str, post_process: Callable[[str], str] | None = None, **kwargs) -> str:
+    def _send(self, messages: list[ChatMessage], params: dict, metrics: RequestMetrics) -> str:
+        result = self._chat_completion(messages=messages, params=params, metrics=metrics)
+        # the maritalk client returns only the text, the tokens are counted on this side
+        completion_tokens = self.token_counter.count(result)
+        metrics.prompt_tokens += self.token_counter.count("".join(msg.content for msg in messages))
+        metrics.completion_tokens += completion_tokens
+        metrics.estimated_tokens = True
+        # no finish reason either, an answer as long as max_tokens is taken as cut
+        metrics.truncated = completion_tokens >= params["max_tokens"]
+        return result.strip()
+
+    def _request(self, messages: list[ChatMessage], params: dict, metrics: RequestMetrics) -> str:
+        if self.hedging is None:
+            return self._send(messages, params, metrics)
+        # the maritalk client has no timeout, a hung request is only left behind
+        return self.hedging.call(lambda m: self._send(messages, params, m), metrics)
+
+    def _request_within_budget(
+        self, messages: list[ChatMessage], params: dict, token_budget: int | None, metrics: RequestMetrics
+    ) -> str:
+        """see OpenAIChatCompletionWrapper._request_within_budget"""
+        if token_budget is None or token_budget >= params["max_tokens"]:
+            return self._request(messages, params, metrics)
+        result = self._request(messages, dict(params, max_tokens=token_budget), metrics)
+        if not metrics.truncated:
+            return result
+        metrics.budget_retries += 1
+        return self._request(messages, params, metrics)
+
+    def _complete(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+    ) -> str:
+        """stateless completion, it does not touch self.messages
+
+        The maritalk client has no streaming, so stream, stop_when and on_text are accepted for compatibility with the
+        other wrappers, but the whole completion is always generated (and on_text is never called).
+        """
+        with track_request("maritalk", "MariTalk") as metrics:
+            if self.cache is None:
+                return self._request_within_budget(messages, params, token_budget, metrics)
+            return self.cache.get_or_complete(
+                "MariTalk",
+                params,
+                messages,
+                lambda: self._request_within_budget(messages, params, token_budget, metrics),
+            )
+
+    async def _acomplete(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+    ) -> str:
+        # the maritalk client is blocking only, so it runs in a worker thread
+        return await asyncio.to_thread(self._complete, messages, params, stream, stop_when, None, token_budget)
+
+    def sample(self, message: str, n: int, system_content: str | None = None, **kwargs) -> list[str]:
+        """see OpenAIChatCompletionWrapper.sample. The maritalk client returns a single answer per request, so n
+        requests are sent concurrently"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        params = self._kwargs_to_generation_params(kwargs)
+
+        def sample() -> str:
+            return json.dumps(sample_concurrently(lambda m: self._request(messages, params, m), n, metrics))
+
+        with track_request("maritalk", "MariTalk") as metrics:
+            if self.cache is None:
+                return json.loads(sample())
+            return json.loads(self.cache.get_or_complete("MariTalk", dict(params, n=n), messages, sample))
+
+    async def asample(self, message: str, n: int, system_content: str | None = None, **kwargs) -> list[str]:
+        # the maritalk client is blocking only, so it runs in a worker thread
+        return await asyncio.to_thread(self.sample, message, n, system_content, **kwargs)
+
+    def __call__(
+        self,
+        message: str,
+        post_process: Callable[[str], str] | None = None,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+        **kwargs,
+    ) -> str:
+        """see OpenAIChatCompletionWrapper.__call__"""
         self.messages.append(ChatMessage(role="user", content=message))
         if self.log:
             logger(content=self.messages[-1])
 
         params = self._kwargs_to_generation_params(kwargs)
-        completion = self._chat_completion(params=params)
-        result = completion.strip()
+        result = self._complete(
+            self.messages, params, stream=stream, stop_when=stop_when, on_text=on_text, token_budget=token_budget
+        )
 
         if post_process is not None:
             if self.log:
@@ -80,3 +198,40 @@ class MariTalkChatCompletionWrapper:
             logger(content=self.messages[-1])
 
         return result
+
+    async def acall(
+        self,
+        message: str,
+        post_process: Callable[[str], str] | None = None,
+        system_content: str | None = None,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+        **kwargs,
+    ) -> str:
+        """async version of __call__. Each call is a single-turn session of its own (self.messages is not used),
+        so many calls can be in flight at the same time"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        if self.log:
+            for msg in messages:
+                logger(content=msg)
+
+        params = self._kwargs_to_generation_params(kwargs)
+        result = await self._acomplete(
+            messages, params, stream=stream, stop_when=stop_when, on_text=on_text, token_budget=token_budget
+        )
+
+        if post_process is not None:
+            if self.log:
+                logger(
+                    observation="assistant-before-post-process",
+                    content=ChatMessage(role="assistant", content=result),
+                )
+            result = post_process(result)
+
+        if self.log:
+            logger(content=ChatMessage(role="assistant", content=result))
+
+        return result
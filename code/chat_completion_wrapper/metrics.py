@@ -0,0 +1,305 @@
+import os
+import math
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# dollars per 1K prompt and completion tokens of each provider and model prefix, the longest matching prefix is used
+# None when the price is not per token (the Hugging Face endpoints are paid per hour) or unknown
+DEFAULT_PRICES = {
+    ("openai", "gpt-3.5-turbo"): dict(prompt=0.0015, completion=0.002),
+    ("openai", "gpt-3.5-turbo-16k"): dict(prompt=0.003, completion=0.004),
+    ("openai", "gpt-4"): dict(prompt=0.03, completion=0.06),
+    ("openai", "gpt-4-32k"): dict(prompt=0.06, completion=0.12),
+    ("huggingface", ""): None,
+    ("maritalk", ""): None,
+}
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+# labels added to the metrics of the requests made in this context, e.g., the dataset being evaluated
+_metric_labels: contextvars.ContextVar[dict] = contextvars.ContextVar("metric_labels", default={})
+
+
+@contextmanager
+def metric_labels(**labels: str):
+    """the requests made inside the block (including the asyncio tasks started in it) are labeled, e.g.,
+    with metric_labels(dataset="Zero-shot"): ..."""
+    token = _metric_labels.set(dict(_metric_labels.get(), **labels))
+    try:
+        yield
+    finally:
+        _metric_labels.reset(token)
+
+
+@dataclass
+class RequestMetrics:
+    """Measurements of one wrapper call, filled in by the wrapper while the request is made.
+
+    attempts is 0 when the answer came from the cache. The prompt tokens are counted with the token counter of the
+    wrapper when the provider does not report them (streaming, MariTalk), then estimated_tokens is True.
+    """
+
+    provider: str
+    model: str
+    labels: dict = field(default_factory=dict)
+    started_at: float = field(default_factory=time.perf_counter)
+    wall_time: float | None = None
+    time_to_first_token: float | None = None  # only for streamed answers
+    attempts: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimated_tokens: bool = False
+    cost: float | None = None
+    error: str | None = None
+    hedged: bool = False  # a duplicate was sent, see HedgingPolicy
+    hedge_won: bool = False
+    truncated: bool = False  # the last answer was cut by max tokens (finish_reason length)
+    budget_retries: int = 0  # answers cut by the token budget and generated again with the full max tokens
+
+    @property
+    def cached(self) -> bool:
+        return self.attempts == 0 and self.error is None
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+    def first_token(self) -> None:
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self.started_at
+
+    def fork(self) -> "RequestMetrics":
+        """empty metrics of another request made for the same call, e.g., a duplicate or one of several samples"""
+        return RequestMetrics(provider=self.provider, model=self.model, labels=self.labels, started_at=self.started_at)
+
+    def add(self, other: "RequestMetrics") -> None:
+        """adds the measurements of a forked request, whose tokens were also paid for"""
+        self.attempts += other.attempts
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.estimated_tokens = self.estimated_tokens or other.estimated_tokens
+        self.hedged = self.hedged or other.hedged
+        self.hedge_won = self.hedge_won or other.hedge_won
+        self.budget_retries += other.budget_retries
+
+
+class _MetricsAggregate:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.cached = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.estimated_tokens = 0  # requests with estimated token counts
+        self.cost = 0.0
+        self.priced = 0  # requests with a known cost
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_retries = 0
+        self.wall_times: list[float] = []
+        self.times_to_first_token: list[float] = []
+
+    def add(self, metrics: RequestMetrics) -> None:
+        self.requests += 1
+        self.cached += metrics.cached
+        self.errors += metrics.error is not None
+        self.retries += metrics.retries
+        self.prompt_tokens += metrics.prompt_tokens
+        self.completion_tokens += metrics.completion_tokens
+        self.estimated_tokens += metrics.estimated_tokens
+        if metrics.cost is not None:
+            self.cost += metrics.cost
+            self.priced += 1
+        self.hedged += metrics.hedged
+        self.hedge_wins += metrics.hedge_won
+        self.budget_retries += metrics.budget_retries
+        if not metrics.cached:
+            self.wall_times.append(metrics.wall_time)
+            if metrics.time_to_first_token is not None:
+                self.times_to_first_token.append(metrics.time_to_first_token)
+
+    def copy(self) -> "_MetricsAggregate":
+        aggregate = _MetricsAggregate()
+        for name, value in vars(self).items():
+            setattr(aggregate, name, list(value) if isinstance(value, list) else value)
+        return aggregate
+
+    def since(self, before: "_MetricsAggregate") -> "_MetricsAggregate":
+        """the requests recorded after the copy before, the times are appended so the new ones are at the end"""
+        aggregate = _MetricsAggregate()
+        for name, value in vars(self).items():
+            previous = getattr(before, name)
+            setattr(aggregate, name, value[len(previous) :] if isinstance(value, list) else value - previous)
+        return aggregate
+
+
+def get_quantile(values: list[float], q: float) -> float | None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+
+def _summarize_times(values: list[float]) -> dict:
+    return dict(
+        count=len(values),
+        sum=sum(values),
+        **{f"p{round(q * 100)}": get_quantile(values, q) for q in QUANTILES},
+        max=max(values, default=None),
+    )
+
+
+def _format_labels(labels: dict) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricsRecorder:
+    """Aggregates the metrics of the requests by provider, model and the labels of metric_labels (e.g., dataset).
+
+    The wall times are kept to compute the quantiles, a few floats per request. It is thread-safe.
+    """
+
+    def __init__(self, label_names: tuple[str, ...] = ("dataset",)) -> None:
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.aggregates: dict[tuple, _MetricsAggregate] = {}
+        self.prices: dict[tuple[str, str], dict | None] = dict(DEFAULT_PRICES)
+
+    def get_price(self, provider: str, model: str) -> dict | None:
+        keys = [key for key in self.prices if key[0] == provider and model.startswith(key[1])]
+        return self.prices[max(keys, key=lambda key: len(key[1]))] if len(keys) > 0 else None
+
+    def configure_price(self, provider: str, model: str, prompt: float | None, completion: float | None) -> None:
+        """dollars per 1K tokens of a provider and model (or model prefix), None to not estimate the cost"""
+        with self.lock:
+            self.prices[(provider, model)] = None if prompt is None else dict(prompt=prompt, completion=completion)
+
+    def record(self, metrics: RequestMetrics) -> None:
+        price = self.get_price(metrics.provider, metrics.model)
+        if price is not None and not metrics.cached:
+            metrics.cost = (
+                metrics.prompt_tokens * price["prompt"] + metrics.completion_tokens * price["completion"]
+            ) / 1000
+        key = (metrics.provider, metrics.model, *(metrics.labels.get(name, "") for name in self.label_names))
+        with self.lock:
+            self.aggregates.setdefault(key, _MetricsAggregate()).add(metrics)
+
+    def snapshot(self) -> dict[tuple, _MetricsAggregate]:
+        """the totals so far, to summarize only the requests made after it, see summary"""
+        with self.lock:
+            return {key: aggregate.copy() for key, aggregate in self.aggregates.items()}
+
+    def summary(self, since: dict[tuple, _MetricsAggregate] | None = None, **filters: str) -> dict:
+        """totals of the requests matching the filters (provider, model or labels), e.g., summary(model=m, dataset=d),
+        only of the requests made after the snapshot since, if given"""
+        names = ("provider", "model", *self.label_names)
+        total = _MetricsAggregate()
+        with self.lock:
+            for key, aggregate in self.aggregates.items():
+                if any(dict(zip(names, key)).get(name) != value for name, value in filters.items()):
+                    continue
+                if since is not None and key in since:
+                    aggregate = aggregate.since(since[key])
+                for name in vars(total):
+                    setattr(total, name, getattr(total, name) + getattr(aggregate, name))
+        return dict(
+            **filters,
+            requests=total.requests,
+            cached=total.cached,
+            errors=total.errors,
+            retries=total.retries,
+            prompt_tokens=total.prompt_tokens,
+            completion_tokens=total.completion_tokens,
+            estimated_tokens=total.estimated_tokens,
+            cost=total.cost if total.priced > 0 else None,
+            hedged=total.hedged,
+            hedge_wins=total.hedge_wins,
+            budget_retries=total.budget_retries,
+            wall_time=_summarize_times(total.wall_times),
+            time_to_first_token=_summarize_times(total.times_to_first_token),
+        )
+
+    def to_prometheus(self) -> str:
+        """the metrics in the Prometheus text format"""
+        names = ("provider", "model", *self.label_names)
+        with self.lock:
+            aggregates = [(dict(zip(names, key)), aggregate) for key, aggregate in sorted(self.aggregates.items())]
+
+        lines = []
+        counters = [
+            ("llm_requests_total", "Wrapper calls, including the ones answered by the cache.", "requests"),
+            ("llm_cached_requests_total", "Wrapper calls answered by the cache.", "cached"),
+            ("llm_errors_total", "Wrapper calls that raised an error.", "errors"),
+            ("llm_retries_total", "Requests sent again after an error.", "retries"),
+            ("llm_prompt_tokens_total", "Prompt tokens sent.", "prompt_tokens"),
+            ("llm_completion_tokens_total", "Completion tokens generated.", "completion_tokens"),
+            ("llm_cost_dollars_total", "Estimated cost of the requests with a known price.", "cost"),
+            ("llm_hedged_requests_total", "Requests with a duplicate sent because they were slow.", "hedged"),
+            ("llm_hedge_wins_total", "Hedged requests answered first by the duplicate.", "hedge_wins"),
+            ("llm_budget_retries_total", "Answers cut by the token budget, generated again.", "budget_retries"),
+        ]
+        for metric, description, attribute in counters:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+            for labels, aggregate in aggregates:
+                lines.append(f"{metric}{_format_labels(labels)} {getattr(aggregate, attribute)}")
+
+        summaries = [
+            ("llm_request_duration_seconds", "Wall time of the requests, retries included.", "wall_times"),
+            ("llm_time_to_first_token_seconds", "Time to the first streamed token.", "times_to_first_token"),
+        ]
+        for metric, description, attribute in summaries:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} summary"]
+            for labels, aggregate in aggregates:
+                values = getattr(aggregate, attribute)
+                for q in QUANTILES:
+                    quantile = get_quantile(values, q)
+                    value = "NaN" if quantile is None else quantile
+                    lines.append(f"{metric}{_format_labels(dict(labels, quantile=q))} {value}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {sum(values)}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """writes the metrics file atomically, e.g., for the textfile collector of the node exporter"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+_metrics_recorder: MetricsRecorder | None = None
+_lock = threading.Lock()
+
+
+def get_metrics_recorder() -> MetricsRecorder:
+    """every wrapper in this process records into the same recorder"""
+    global _metrics_recorder
+    with _lock:
+        if _metrics_recorder is None:
+            _metrics_recorder = MetricsRecorder()
+        return _metrics_recorder
+
+
+def configure_price(provider: str, model: str, prompt: float | None, completion: float | None) -> None:
+    get_metrics_recorder().configure_price(provider, model, prompt, completion)
+
+
+@contextmanager
+def track_request(provider: str, model: str):
+    """measures a wrapper call, the wrapper fills in the yielded RequestMetrics, recorded when the block ends"""
+    metrics = RequestMetrics(provider=provider, model=model, labels=_metric_labels.get())
+    try:
+        yield metrics
+    except BaseException as e:
+        metrics.error = type(e).__name__
+        raise
+    finally:
+        metrics.wall_time = time.perf_counter() - metrics.started_at
+        get_metrics_recorder().record(metrics)
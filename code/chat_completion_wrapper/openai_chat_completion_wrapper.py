@@ -1,33 +1,71 @@
 import os
+import json
+import asyncio
 import openai
-from typing import Callable
+from typing import AsyncIterator, Callable, Iterator, Sequence
 import random
 import time
-from chat_completion_wrapper import ChatMessage, AuthenticationError
+from chat_completion_wrapper import (
+    ChatMessage,
+    AuthenticationError,
+    ResponseCache,
+    get_rate_limiter,
+    get_token_counter,
+    HTTPTransport,
+    get_http_transport,
+    consume_stream,
+    aconsume_stream,
+    get_cache_params,
+    ANSWER_CHOICES,
+    RequestMetrics,
+    track_request,
+    get_hedging_policy,
+)
+from chat_completion_wrapper.rate_limiter import estimate_tokens
 from logger import logger
 import dataclasses
 
+# also used to build the requests of the batch mode, see evaluator.export_batch
+DEFAULT_GENERATION_PARAMS = dict(
+    temperature=0,
+    max_tokens=1024,
+    top_p=1,
+    frequency_penalty=0,
+    presence_penalty=0,
+)
+
+# a single output token with the most likely first tokens, see score_choices. 20 is the most the API returns
+SCORE_PARAMS = dict(max_tokens=1, logprobs=True, top_logprobs=20)
+
 
 class OpenAIChatCompletionWrapper:
-    def __init__(self, model: str, log: bool = True, openai_api_key: str | None = None) -> None:
+    def __init__(
+        self,
+        model: str,
+        log: bool = True,
+        openai_api_key: str | None = None,
+        cache: ResponseCache | None = None,
+        http_transport: HTTPTransport | None = None,
+    ) -> None:
+        # the openai module uses the sessions of the shared transport (see get_http_transport), this one sets the
+        # timeouts and the aiohttp sessions
+        self.http_transport = get_http_transport() if http_transport is None else http_transport
+
         if openai_api_key is None:
             assert "OPENAI_API_KEY" in os.environ
-        else:
-            # assert "OPENAI_API_KEY" not in os.environ
-            openai.api_key = openai_api_key
+        # sent with each request instead of set in the openai module, so wrappers with different keys (e.g., of the
+        # users of the streamlit app) can be used at the same time. None uses OPENAI_API_KEY
+        self.api_key = openai_api_key
         self.check_api_key()
 
         self.log = log
+        self.cache = cache
+        self.rate_limiter = get_rate_limiter("openai", model)
+        self.token_counter = get_token_counter("openai", model)
+        self.hedging = get_hedging_policy("openai", model)  # None unless configured
 
         # generation parameter
-        self._default_generation_params = dict(
-            model=model,
-            temperature=0,
-            max_tokens=1024,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
+        self._default_generation_params = dict(model=model, **DEFAULT_GENERATION_PARAMS)
 
         self.openai_errors: tuple = (
             openai.error.Timeout,
@@ -39,7 +77,7 @@ class OpenAIChatCompletionWrapper:
 
     def check_api_key(self):
         try:
-            openai.Model.list()
+            openai.Model.list(api_key=self.api_key)
         except openai.error.AuthenticationError as e:
             raise AuthenticationError from e
 
@@ -65,9 +103,16 @@ class OpenAIChatCompletionWrapper:
         params = dict(self._default_generation_params, **kwargs)  # overwriting default parameters
         return params
 
+    def _estimate_tokens(self, messages: list[ChatMessage], params: dict) -> int:
+        # the n answers of a request are all counted
+        max_tokens = params.get("max_tokens", 0) * params.get("n", 1)
+        return estimate_tokens("".join(msg.content for msg in messages), max_tokens, self.token_counter)
+
     def _completions_with_backoff(
         self,
+        messages: list[ChatMessage],
         params: dict = {},
+        metrics: RequestMetrics | None = None,
         initial_delay: float = 1,
         exponential_base: float = 2,
         jitter: bool = True,
@@ -78,21 +123,26 @@ class OpenAIChatCompletionWrapper:
         # Initialize variables
         num_retries = 0
         delay = initial_delay
+        tokens = self._estimate_tokens(messages, params)
 
         # Loop until a successful response or max_retries is hit or an exception is raised
         while True:
+            # waits for the rate limit, so the errors below should be the exception, not the rule
+            self.rate_limiter.acquire(tokens)
+            if metrics is not None:
+                metrics.attempts += 1
             try:
                 return openai.ChatCompletion.create(
-                    messages=[dataclasses.asdict(msg) for msg in self.messages],
+                    messages=[dataclasses.asdict(msg) for msg in messages],
                     **params,
-                    request_timeout=60,
+                    api_key=self.api_key,
+                    request_timeout=self.http_transport.timeout,
                 )
 
             # Retry on specified errors
             except self.openai_errors as e:
                 if self.log:
                     logger(observation="Error", content=str(e))
-                    logger.save()
 
                 # Increment retries
                 num_retries += 1
@@ -107,22 +157,388 @@ class OpenAIChatCompletionWrapper:
                 # Sleep for the delay
                 if self.log:
                     logger(observation="Info", content=f"Waiting {delay} before another attempt.")
-                    logger.save()
                 time.sleep(delay)
 
             # Raise exceptions for any errors not specified
             except Exception as e:
                 raise e
 
-    def __call__(self, message: str, post_process: Callable[[str], str] | None = None, **kwargs) -> str:
+    async def _acompletions_with_backoff(
+        self,
+        messages: list[ChatMessage],
+        params: dict = {},
+        metrics: RequestMetrics | None = None,
+        initial_delay: float = 1,
+        exponential_base: float = 2,
+        jitter: bool = True,
+        max_retries: int = 10,
+    ) -> dict:
+        # same as _completions_with_backoff, but non-blocking
+        num_retries = 0
+        delay = initial_delay
+        tokens = self._estimate_tokens(messages, params)
+
+        while True:
+            await self.rate_limiter.aacquire(tokens)
+            # otherwise openai opens a new aiohttp session (and connection) for each request
+            aiohttp_session = await self.http_transport.get_aiohttp_session()
+            if aiohttp_session is not None:
+                openai.aiosession.set(aiohttp_session)
+            if metrics is not None:
+                metrics.attempts += 1
+            try:
+                return await openai.ChatCompletion.acreate(
+                    messages=[dataclasses.asdict(msg) for msg in messages],
+                    **params,
+                    api_key=self.api_key,
+                    request_timeout=self.http_transport.timeout,
+                )
+
+            except self.openai_errors as e:
+                if self.log:
+                    logger(observation="Error", content=str(e))
+
+                num_retries += 1
+                if num_retries > max_retries:
+                    raise Exception(f"Maximum number of retries ({max_retries}) exceeded.")
+
+                delay *= exponential_base * (1 + jitter * random.random())
+
+                if self.log:
+                    logger(observation="Info", content=f"Waiting {delay} before another attempt.")
+                await asyncio.sleep(delay)
+
+    def _count_streamed_chunk(self, chunk, metrics: RequestMetrics) -> str:
+        """the content of a streamed chunk, each chunk with content is a token"""
+        if chunk.choices[0].get("finish_reason") is not None:
+            metrics.truncated = chunk.choices[0].finish_reason == "length"
+        content = chunk.choices[0].delta.get("content", "")
+        if content != "":
+            metrics.first_token()
+            metrics.completion_tokens += 1
+        return content
+
+    def _stream_chunks(self, messages: list[ChatMessage], params: dict, metrics: RequestMetrics) -> Iterator[str]:
+        stream = self._completions_with_backoff(messages=messages, params=dict(params, stream=True), metrics=metrics)
+        try:
+            for chunk in stream:
+                if len(chunk.choices) > 0:
+                    yield self._count_streamed_chunk(chunk, metrics)
+        finally:
+            stream.close()  # closing the stream early drops the connection, cancelling the generation
+
+    async def _astream_chunks(
+        self, messages: list[ChatMessage], params: dict, metrics: RequestMetrics
+    ) -> AsyncIterator[str]:
+        stream = await self._acompletions_with_backoff(
+            messages=messages, params=dict(params, stream=True), metrics=metrics
+        )
+        try:
+            async for chunk in stream:
+                if len(chunk.choices) > 0:
+                    yield self._count_streamed_chunk(chunk, metrics)
+        finally:
+            await stream.aclose()
+
+    def _count_prompt_tokens(self, messages: list[ChatMessage], metrics: RequestMetrics) -> None:
+        """the streamed completions have no usage, the tokens are counted on this side"""
+        metrics.prompt_tokens += self.token_counter.count("".join(msg.content for msg in messages))
+        metrics.estimated_tokens = True
+
+    def _count_usage(self, completion, metrics: RequestMetrics) -> None:
+        metrics.prompt_tokens += completion.usage.prompt_tokens
+        metrics.completion_tokens += completion.usage.completion_tokens
+
+    def _send(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        metrics.truncated = False
+        if stream or stop_when is not None or on_text is not None:
+            self._count_prompt_tokens(messages, metrics)
+            return consume_stream(self._stream_chunks(messages, params, metrics), stop_when, on_text).strip()
+        completion = self._completions_with_backoff(messages=messages, params=params, metrics=metrics)
+        self._count_usage(completion, metrics)
+        metrics.truncated = completion.choices[0].finish_reason == "length"
+        return completion.choices[0].message.content.strip()
+
+    async def _asend(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        metrics.truncated = False
+        if stream or stop_when is not None or on_text is not None:
+            self._count_prompt_tokens(messages, metrics)
+            return (await aconsume_stream(self._astream_chunks(messages, params, metrics), stop_when, on_text)).strip()
+        completion = await self._acompletions_with_backoff(messages=messages, params=params, metrics=metrics)
+        self._count_usage(completion, metrics)
+        metrics.truncated = completion.choices[0].finish_reason == "length"
+        return completion.choices[0].message.content.strip()
+
+    def _request(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        if self.hedging is None or on_text is not None:  # on_text would get the text of both requests
+            return self._send(messages, params, stream, stop_when, on_text, metrics)
+        return self.hedging.call(lambda m: self._send(messages, dict(params), stream, stop_when, None, m), metrics)
+
+    async def _arequest(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        if self.hedging is None or on_text is not None:
+            return await self._asend(messages, params, stream, stop_when, on_text, metrics)
+        return await self.hedging.acall(
+            lambda m: self._asend(messages, dict(params), stream, stop_when, None, m), metrics
+        )
+
+    def _request_within_budget(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        token_budget: int | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        """the answer generated with max_tokens=token_budget, and again with the full max_tokens if it was cut"""
+        if token_budget is None or token_budget >= params["max_tokens"]:
+            return self._request(messages, params, stream, stop_when, on_text, metrics)
+        result = self._request(messages, dict(params, max_tokens=token_budget), stream, stop_when, on_text, metrics)
+        if not metrics.truncated:
+            return result
+        metrics.budget_retries += 1
+        return self._request(messages, params, stream, stop_when, on_text, metrics)
+
+    async def _arequest_within_budget(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool,
+        stop_when: Callable[[str], bool] | None,
+        on_text: Callable[[str], None] | None,
+        token_budget: int | None,
+        metrics: RequestMetrics,
+    ) -> str:
+        if token_budget is None or token_budget >= params["max_tokens"]:
+            return await self._arequest(messages, params, stream, stop_when, on_text, metrics)
+        budget_params = dict(params, max_tokens=token_budget)
+        result = await self._arequest(messages, budget_params, stream, stop_when, on_text, metrics)
+        if not metrics.truncated:
+            return result
+        metrics.budget_retries += 1
+        return await self._arequest(messages, params, stream, stop_when, on_text, metrics)
+
+    def _complete(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+    ) -> str:
+        """stateless completion, it does not touch self.messages. The answer is cached under the full max_tokens,
+        an answer generated within the token budget is the same"""
+        with track_request("openai", params["model"]) as metrics:
+            if self.cache is None:
+                return self._request_within_budget(messages, params, stream, stop_when, on_text, token_budget, metrics)
+            return self.cache.get_or_complete(
+                params["model"],
+                get_cache_params(params, stop_when),
+                messages,
+                lambda: self._request_within_budget(
+                    messages, params, stream, stop_when, on_text, token_budget, metrics
+                ),
+            )
+
+    async def _acomplete(
+        self,
+        messages: list[ChatMessage],
+        params: dict,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+    ) -> str:
+        with track_request("openai", params["model"]) as metrics:
+            if self.cache is None:
+                return await self._arequest_within_budget(
+                    messages, params, stream, stop_when, on_text, token_budget, metrics
+                )
+            return await self.cache.aget_or_complete(
+                params["model"],
+                get_cache_params(params, stop_when),
+                messages,
+                lambda: self._arequest_within_budget(
+                    messages, params, stream, stop_when, on_text, token_budget, metrics
+                ),
+            )
+
+    @staticmethod
+    def _get_choice_logprobs(completion, choices: Sequence[str]) -> dict[str, float | None]:
+        """the log probability of each choice among the top first tokens, e.g., "B" and " B" are the same choice"""
+        logprobs = dict.fromkeys(choices)
+        for top_logprob in completion.choices[0].logprobs.content[0].top_logprobs:
+            choice = top_logprob.token.strip()
+            if choice in logprobs and (logprobs[choice] is None or top_logprob.logprob > logprobs[choice]):
+                logprobs[choice] = top_logprob.logprob
+        return logprobs
+
+    def _score(
+        self, messages: list[ChatMessage], params: dict, choices: Sequence[str], metrics: RequestMetrics
+    ) -> dict[str, float | None]:
+        completion = self._completions_with_backoff(messages=messages, params=params, metrics=metrics)
+        self._count_usage(completion, metrics)
+        return self._get_choice_logprobs(completion, choices)
+
+    async def _ascore(
+        self, messages: list[ChatMessage], params: dict, choices: Sequence[str], metrics: RequestMetrics
+    ) -> dict[str, float | None]:
+        completion = await self._acompletions_with_backoff(messages=messages, params=params, metrics=metrics)
+        self._count_usage(completion, metrics)
+        return self._get_choice_logprobs(completion, choices)
+
+    def score_choices(
+        self, message: str, choices: Sequence[str] = ANSWER_CHOICES, **kwargs
+    ) -> dict[str, float | None]:
+        """the log probability of each choice being the first token of the answer, with a single output token
+        instead of a whole answer. None for a choice that is not among the 20 most likely tokens. Each call is
+        single-turn (self.messages is not used), the answers are cached as json
+
+        Args:
+            message (str): the user message, e.g., a question asking for the letter of the answer.
+            choices (Sequence[str]): the answer tokens to score. Defaults to ANSWER_CHOICES (A to E).
+        """
+        messages = [ChatMessage(role="user", content=message)]
+        params = dict(self._kwargs_to_generation_params(kwargs), **SCORE_PARAMS)
+        with track_request("openai", params["model"]) as metrics:
+            if self.cache is None:
+                return self._score(messages, params, choices, metrics)
+            return json.loads(
+                self.cache.get_or_complete(
+                    params["model"],
+                    dict(params, choices=list(choices)),
+                    messages,
+                    lambda: json.dumps(self._score(messages, params, choices, metrics)),
+                )
+            )
+
+    async def ascore_choices(
+        self, message: str, choices: Sequence[str] = ANSWER_CHOICES, **kwargs
+    ) -> dict[str, float | None]:
+        """async version of score_choices"""
+        messages = [ChatMessage(role="user", content=message)]
+        params = dict(self._kwargs_to_generation_params(kwargs), **SCORE_PARAMS)
+        with track_request("openai", params["model"]) as metrics:
+            if self.cache is None:
+                return await self._ascore(messages, params, choices, metrics)
+
+            async def score() -> str:
+                return json.dumps(await self._ascore(messages, params, choices, metrics))
+
+            return json.loads(
+                await self.cache.aget_or_complete(params["model"], dict(params, choices=list(choices)), messages, score)
+            )
+
+    def _sample(self, messages: list[ChatMessage], params: dict, metrics: RequestMetrics) -> list[str]:
+        completion = self._completions_with_backoff(messages=messages, params=params, metrics=metrics)
+        self._count_usage(completion, metrics)
+        return [choice.message.content.strip() for choice in completion.choices]
+
+    async def _asample(self, messages: list[ChatMessage], params: dict, metrics: RequestMetrics) -> list[str]:
+        completion = await self._acompletions_with_backoff(messages=messages, params=params, metrics=metrics)
+        self._count_usage(completion, metrics)
+        return [choice.message.content.strip() for choice in completion.choices]
+
+    def sample(self, message: str, n: int, system_content: str | None = None, **kwargs) -> list[str]:
+        """n answers to the message from a single request (the n parameter), e.g., with a temperature above 0 for
+        self-consistency. Each call is single-turn (self.messages is not used), the answers are cached as json
+
+        Args:
+            message (str): the user message.
+            n (int): number of answers.
+            system_content (str | None): the system message. Defaults to None.
+        """
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        params = dict(self._kwargs_to_generation_params(kwargs), n=n)
+        with track_request("openai", params["model"]) as metrics:
+            if self.cache is None:
+                return self._sample(messages, params, metrics)
+            return json.loads(
+                self.cache.get_or_complete(
+                    params["model"], params, messages, lambda: json.dumps(self._sample(messages, params, metrics))
+                )
+            )
+
+    async def asample(self, message: str, n: int, system_content: str | None = None, **kwargs) -> list[str]:
+        """async version of sample"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        params = dict(self._kwargs_to_generation_params(kwargs), n=n)
+        with track_request("openai", params["model"]) as metrics:
+            if self.cache is None:
+                return await self._asample(messages, params, metrics)
+
+            async def sample() -> str:
+                return json.dumps(await self._asample(messages, params, metrics))
+
+            return json.loads(await self.cache.aget_or_complete(params["model"], params, messages, sample))
+
+    def __call__(
+        self,
+        message: str,
+        post_process: Callable[[str], str] | None = None,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+        **kwargs,
+    ) -> str:
+        """sends the message and returns the answer
+
+        Args:
+            message (str): the user message.
+            post_process (Callable[[str], str] | None): applied to the answer before adding it to the session.
+            stream (bool): streams the answer instead of waiting for the whole completion.
+            stop_when (Callable[[str], bool] | None): called with the partial answer while streaming (implies stream),
+                the generation is cancelled as soon as it returns True.
+            on_text (Callable[[str], None] | None): called with the partial answer each time a token arrives (implies
+                stream), e.g., to show the answer while it is generated. Not called when the answer is cached.
+            token_budget (int | None): max tokens of the first attempt, the answer is generated again with the full
+                max tokens only if it was cut (finish_reason length). Defaults to None (the full max tokens).
+        """
         self.messages.append(ChatMessage(role="user", content=message))
         if self.log:
             logger(content=self.messages[-1])
 
         params = self._kwargs_to_generation_params(kwargs)
-        completion = self._completions_with_backoff(params=params)
-        result = completion.choices[0].message.content
-        result = result.strip()
+        result = self._complete(
+            self.messages, params, stream=stream, stop_when=stop_when, on_text=on_text, token_budget=token_budget
+        )
 
         if post_process is not None:
             if self.log:
@@ -137,3 +553,40 @@ class OpenAIChatCompletionWrapper:
             logger(content=self.messages[-1])
 
         return result
+
+    async def acall(
+        self,
+        message: str,
+        post_process: Callable[[str], str] | None = None,
+        system_content: str | None = None,
+        stream: bool = False,
+        stop_when: Callable[[str], bool] | None = None,
+        on_text: Callable[[str], None] | None = None,
+        token_budget: int | None = None,
+        **kwargs,
+    ) -> str:
+        """async version of __call__. Each call is a single-turn session of its own (self.messages is not used),
+        so many calls can be in flight at the same time"""
+        messages = [] if system_content is None else [ChatMessage(role="system", content=system_content)]
+        messages.append(ChatMessage(role="user", content=message))
+        if self.log:
+            for msg in messages:
+                logger(content=msg)
+
+        params = self._kwargs_to_generation_params(kwargs)
+        result = await self._acomplete(
+            messages, params, stream=stream, stop_when=stop_when, on_text=on_text, token_budget=token_budget
+        )
+
+        if post_process is not None:
+            if self.log:
+                logger(
+                    observation="assistant-before-post-process",
+                    content=ChatMessage(role="assistant", content=result),
+                )
+            result = post_process(result)
+
+        if self.log:
+            logger(content=ChatMessage(role="assistant", content=result))
+
+        return result
@@ -0,0 +1,101 @@
+import time
+import asyncio
+import threading
+from chat_completion_wrapper.token_counter import TokenCounter
+
+# requests and (estimated) tokens per minute of each provider and model prefix, the longest matching prefix is used
+# nothing is limited until configure_rate_limit() is called, e.g., with the OpenAI limits below
+DEFAULT_RATE_LIMITS: dict[tuple[str, str], dict] = {}
+
+# the default limits of an OpenAI account, by model prefix. OpenAI counts the whole max_tokens of a request in the
+# tokens per minute, so do the estimates (see estimate_tokens); a smaller max_tokens (e.g., a token budget) allows more
+# requests per minute
+OPENAI_RATE_LIMITS = {
+    "gpt-3.5-turbo": dict(rpm=3500, tpm=90000),
+    "gpt-4": dict(rpm=200, tpm=40000),
+}
+
+
+class RateLimiter:
+    """Token bucket limiting the requests per minute (rpm) and the estimated tokens per minute (tpm).
+
+    The buckets start full and refill continuously, so a burst up to the per-minute limit is allowed and then
+    the requests are spread out at the allowed rate. It is thread-safe and can also be awaited.
+    A limit set to None is not enforced.
+    """
+
+    def __init__(self, rpm: int | None = None, tpm: int | None = None) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.lock = threading.Lock()
+        self.available_requests = float(rpm) if rpm is not None else None
+        self.available_tokens = float(tpm) if tpm is not None else None
+        self.last_refill = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        if self.rpm is not None:
+            self.available_requests = min(self.rpm, self.available_requests + elapsed_minutes * self.rpm)
+        if self.tpm is not None:
+            self.available_tokens = min(self.tpm, self.available_tokens + elapsed_minutes * self.tpm)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """takes from the buckets and returns 0, or returns how long to wait before trying again"""
+        with self.lock:
+            self._refill()
+            wait = 0.0
+            if self.rpm is not None and self.available_requests < 1:
+                wait = max(wait, (1 - self.available_requests) / self.rpm * 60)
+            if self.tpm is not None:
+                tokens = min(tokens, self.tpm)  # a request larger than the whole bucket waits for a full bucket
+                if self.available_tokens < tokens:
+                    wait = max(wait, (tokens - self.available_tokens) / self.tpm * 60)
+            if wait > 0:
+                return wait
+            if self.rpm is not None:
+                self.available_requests -= 1
+            if self.tpm is not None:
+                self.available_tokens -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int = 0) -> None:
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+
+_rate_limiters: dict[tuple[str, str], RateLimiter] = {}
+_rate_limits: dict[tuple[str, str], dict] = dict(DEFAULT_RATE_LIMITS)
+_lock = threading.Lock()
+
+
+def configure_rate_limit(provider: str, model: str, rpm: int | None = None, tpm: int | None = None) -> None:
+    """sets the limits of a provider and model (or model prefix). Call it before creating the wrappers"""
+    with _lock:
+        _rate_limits[(provider, model)] = dict(rpm=rpm, tpm=tpm)
+        # wrappers created from now on get the new limits
+        for key in list(_rate_limiters.keys()):
+            if key[0] == provider and key[1].startswith(model):
+                del _rate_limiters[key]
+
+
+def get_rate_limiter(provider: str, model: str) -> RateLimiter:
+    """the same limiter is shared by every wrapper instance of a provider and model in this process"""
+    with _lock:
+        if (provider, model) not in _rate_limiters:
+            # the longest matching prefix wins, e.g., "gpt-4" for "gpt-4-0613"
+            prefixes = [prefix for (p, prefix) in _rate_limits if p == provider and model.startswith(prefix)]
+            limits = _rate_limits[(provider, max(prefixes, key=len))] if len(prefixes) > 0 else {}
+            _rate_limiters[(provider, model)] = RateLimiter(**limits)
+        return _rate_limiters[(provider, model)]
+
+
+def estimate_tokens(text: str, max_tokens: int = 0, token_counter: TokenCounter | None = None) -> int:
+    """token count of a request: its prompt plus the completion budget, which is what the providers count"""
+    prompt_tokens = len(text) // 4 if token_counter is None else token_counter.count(text)
+    return prompt_tokens + max_tokens
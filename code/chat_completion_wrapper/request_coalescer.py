@@ -0,0 +1,141 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from chat_completion_wrapper import ChatMessage, ResponseCache
+
+
+class _Flight:
+    """a request in flight, the identical requests wait for it"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.response: str | None = None
+        self.error: BaseException | None = None
+
+    def result(self) -> str:
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class RequestCoalescer:
+    """In-memory single-flight layer with the interface of ResponseCache, so it can be the cache of the wrappers.
+
+    Identical requests (same model, generation parameters and messages, see ResponseCache.key) made at the same time,
+    e.g., by several sessions of the streamlit app, share a single call to the provider: the first one is sent and
+    the others wait for its answer (or its error). The answers are then kept in a bounded LRU, if cache_when accepts
+    the messages, so the next identical requests are answered without calling the provider.
+
+    Args:
+        max_entries (int): number of answers kept, 0 to only coalesce the requests in flight. Defaults to 1024.
+        max_age (float | None): seconds an answer is kept. Defaults to None (no limit).
+        cache_when (Callable[[list[ChatMessage]], bool] | None): whether the answer to the messages is kept, e.g.,
+            only for the questions of the dataset. Defaults to None (every answer).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_age: float | None = None,
+        cache_when: Callable[[list[ChatMessage]], bool] | None = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.cache_when = cache_when
+        self.lock = threading.Lock()
+        self.responses: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.flights: dict[str, _Flight] = {}
+
+        # how the requests were answered
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _get(self, key: str) -> str | None:
+        """the kept answer, call it holding the lock"""
+        if key not in self.responses:
+            return None
+        response, created_at = self.responses[key]
+        if self.max_age is not None and time.monotonic() - created_at > self.max_age:
+            del self.responses[key]
+            return None
+        self.responses.move_to_end(key)
+        return response
+
+    def _put(self, key: str, response: str, messages: list[ChatMessage]) -> None:
+        if self.max_entries <= 0 or (self.cache_when is not None and not self.cache_when(messages)):
+            return
+        with self.lock:
+            self.responses[key] = (response, time.monotonic())
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_entries:
+                self.responses.popitem(last=False)
+
+    def _join(self, key: str) -> tuple[str | None, _Flight, bool]:
+        """returns the kept answer, or the flight of the request and whether this caller has to send it"""
+        with self.lock:
+            response = self._get(key)
+            if response is not None:
+                self.hits += 1
+                return response, None, False
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return None, flight, False
+            self.misses += 1
+            flight = self.flights[key] = _Flight()
+            return None, flight, True
+
+    def _land(self, key: str, flight: _Flight) -> None:
+        with self.lock:
+            del self.flights[key]
+        flight.done.set()
+
+    def get_or_complete(
+        self, model: str, params: dict, messages: list[ChatMessage], complete: Callable[[], str]
+    ) -> str:
+        key = ResponseCache.key(model, params, messages)
+        response, flight, leader = self._join(key)
+        if response is not None:
+            return response
+        if not leader:
+            flight.done.wait()
+            return flight.result()
+
+        try:
+            flight.response = complete()
+            self._put(key, flight.response, messages)
+            return flight.response
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+
+    async def aget_or_complete(
+        self, model: str, params: dict, messages: list[ChatMessage], complete: Callable[[], Awaitable[str]]
+    ) -> str:
+        key = ResponseCache.key(model, params, messages)
+        response, flight, leader = self._join(key)
+        if response is not None:
+            return response
+        if not leader:
+            # the request may be in flight in another thread (or event loop), so the wait is on a worker thread
+            await asyncio.to_thread(flight.done.wait)
+            return flight.result()
+
+        try:
+            flight.response = await complete()
+            self._put(key, flight.response, messages)
+            return flight.response
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.responses)
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import dataclasses
+from typing import Awaitable, Callable
+from chat_completion_wrapper import ChatMessage, CacheMissError
+
+# the least recently used entries are evicted every EVICT_EVERY puts, and the uses of the entries are written in
+# batches of as many hits, so max_entries can be exceeded by up to EVICT_EVERY entries
+EVICT_EVERY = 100
+
+
+class ResponseCache:
+    """On-disk cache of chat completions, shared by all the chat completion wrappers.
+
+    The entries are keyed by a hash of the model, the generation parameters and the full message list,
+    so only identical requests are served from the cache (all the wrappers default to temperature=0).
+
+    Args:
+        path (str): sqlite file. It is created if it does not exist.
+        max_entries (int | None): keeps only the most recently used entries (see EVICT_EVERY). Defaults to None (no limit).
+        max_age (float | None): entries older than this (in seconds) are ignored and evicted. Defaults to None (no limit).
+        replay (bool): read-only mode, a request not found in the cache raises CacheMissError. Defaults to False.
+    """
+
+    def __init__(
+        self, path: str, max_entries: int | None = None, max_age: float | None = None, replay: bool = False
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.replay = replay
+        self.lock = threading.Lock()  # the same connection is used by the worker threads
+        self.puts = 0
+        self.last_used: dict[str, float] = {}  # hits not written yet
+
+        if self.replay:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, timeout=30)
+        else:
+            if os.path.dirname(path) != "":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # the timeout is for the other processes writing to the same file (see grid_scheduler.py)
+            self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, last_used_at REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)")
+            self.connection.commit()
+            self.evict()
+
+    @staticmethod
+    def key(model: str, params: dict, messages: list[ChatMessage]) -> str:
+        content = json.dumps(
+            dict(model=model, params=params, messages=[dataclasses.asdict(msg) for msg in messages]),
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created_at = row
+            if self.max_age is not None and time.time() - created_at > self.max_age:
+                return None
+            if not self.replay:
+                self.last_used[key] = time.time()
+                if len(self.last_used) >= EVICT_EVERY:
+                    self._write_last_used()
+                    self.connection.commit()
+            return response
+
+    def _write_last_used(self) -> None:
+        """call it holding the lock"""
+        self.connection.executemany(
+            "UPDATE responses SET last_used_at = ? WHERE key = ?",
+            [(last_used_at, key) for key, last_used_at in self.last_used.items()],
+        )
+        self.last_used.clear()
+
+    def put(self, key: str, model: str, response: str) -> None:
+        if self.replay:
+            return
+        with self.lock:
+            now = time.time()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, model, response, now, now)
+            )
+            self._write_last_used()  # in the same commit
+            self.connection.commit()
+            self.puts += 1
+            evict = self.max_entries is not None and self.puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """removes the expired entries and the least recently used ones above max_entries"""
+        with self.lock:
+            self._write_last_used()
+            if self.max_age is not None:
+                self.connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                if count > self.max_entries:
+                    # the oldest uses, found with the index on last_used_at
+                    self.connection.execute(
+                        "DELETE FROM responses WHERE key IN "
+                        "(SELECT key FROM responses ORDER BY last_used_at ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get_or_complete(
+        self, model: str, params: dict, messages: list[ChatMessage], complete: Callable[[], str]
+    ) -> str:
+        key = self.key(model, params, messages)
+        response = self.get(key)
+        if response is None:
+            if self.replay:
+                raise CacheMissError(f"Request to {model} not found in the cache {self.path}")
+            response = complete()
+            self.put(key, model, response)
+        return response
+
+    async def aget_or_complete(
+        self, model: str, params: dict, messages: list[ChatMessage], complete: Callable[[], Awaitable[str]]
+    ) -> str:
+        key = self.key(model, params, messages)
+        response = self.get(key)
+        if response is None:
+            if self.replay:
+                raise CacheMissError(f"Request to {model} not found in the cache {self.path}")
+            response = await complete()
+            self.put(key, model, response)
+        return response
@@ -0,0 +1,102 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+
+class TokenCounter:
+    """Counts the tokens of a text with a tokenizer, memoizing the counts by a hash of the text.
+
+    The same prompts are counted several times (rate limiter, context length, retries), and the few-shot prompts
+    are long, so the counts of the most recently used texts are kept (only their hashes, not the texts).
+
+    Args:
+        encode (Callable[[str], list]): returns the tokens of a text.
+        max_cache_entries (int): number of counts kept. Defaults to 4096.
+    """
+
+    def __init__(self, encode: Callable[[str], list], max_cache_entries: int = 4096) -> None:
+        self.encode = encode
+        self.max_cache_entries = max_cache_entries
+        self.counts: OrderedDict[bytes, int] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def count(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                return self.counts[key]
+        count = self._count(text)  # out of the lock, tokenizing a long prompt takes a while
+        with self.lock:
+            self.counts[key] = count
+            if len(self.counts) > self.max_cache_entries:
+                self.counts.popitem(last=False)
+        return count
+
+
+class ApproximateTokenCounter(TokenCounter):
+    """used when there is no tokenizer, one token every chars_per_token characters"""
+
+    def __init__(self, chars_per_token: float = 4) -> None:
+        super().__init__(encode=None, max_cache_entries=0)
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return int(len(text) // self.chars_per_token)
+
+
+def load_tiktoken(model: str) -> TokenCounter:
+    """OpenAI tokenizer, needs `pip install tiktoken` (the encoding files are downloaded once and cached by tiktoken)"""
+    import tiktoken
+
+    encoding = tiktoken.encoding_for_model(model)
+    return TokenCounter(lambda text: encoding.encode(text, disallowed_special=()))
+
+
+def load_tokenizer_json(path: str) -> TokenCounter:
+    """Hugging Face tokenizer file (tokenizer.json of the model repository), needs `pip install tokenizers`"""
+    from tokenizers import Tokenizer
+
+    tokenizer = Tokenizer.from_file(path)
+    return TokenCounter(lambda text: tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+# characters per token used when no tokenizer is available
+# 2.5 for the Hugging Face models, see: https://github.com/philschmid/easyllm/blob/2603d0dc5e3950ea5e645036045f8cc6a46608d0/easyllm/clients/huggingface.py#L176C9-L176C9
+DEFAULT_CHARS_PER_TOKEN = {
+    "openai": 4,
+    "huggingface": 2.5,
+    "maritalk": 4,
+}
+
+_token_counters: dict[tuple[str, str], TokenCounter] = {}
+_lock = threading.Lock()
+
+
+def configure_token_counter(provider: str, model: str, token_counter: TokenCounter) -> None:
+    """sets the token counter of a provider and model, e.g., configure_token_counter("huggingface", name, load_tokenizer_json(path))"""
+    with _lock:
+        _token_counters[(provider, model)] = token_counter
+
+
+def get_token_counter(provider: str, model: str) -> TokenCounter:
+    """the same counter (and memo) is shared by every wrapper instance of a provider and model in this process
+
+    If none was configured, OpenAI models use tiktoken when it is installed, otherwise the count is approximated.
+    """
+    with _lock:
+        if (provider, model) not in _token_counters:
+            token_counter = None
+            if provider == "openai":
+                try:
+                    token_counter = load_tiktoken(model)
+                except Exception:  # not installed, unknown model or no access to the encoding files
+                    token_counter = None
+            if token_counter is None:
+                token_counter = ApproximateTokenCounter(DEFAULT_CHARS_PER_TOKEN.get(provider, 4))
+            _token_counters[(provider, model)] = token_counter
+        return _token_counters[(provider, model)]
@@ -0,0 +1,197 @@
+import os
+import json
+import mmap
+import struct
+from functools import cache
+from prompt_builder import few_shot_pre_prompt, cot_few_shot_pre_prompt
+
+# compiled dataset: MAGIC, the length of the index (8 bytes), the index (json) and then the records (json), back to back
+MAGIC = b"LLMENEMSTORE\x02"
+INDEX_LENGTH = struct.Struct("<Q")
+
+# prompt prefixes stored once in the index instead of in every record (the few-shot examples)
+SHARED_PROMPT_PREFIXES = [few_shot_pre_prompt, cot_few_shot_pre_prompt]
+
+
+class Question:
+    """A question of a compiled dataset, only parsed when a field other than id and area is accessed.
+
+    It behaves as the question dict of the json dataset (question["prompt"], question.get("exam"), ...).
+    The prompt is assembled from the shared prefix and the question suffix on each access, so it is not kept in memory.
+    """
+
+    __slots__ = ("id", "area", "_store", "_offset", "_length", "_data")
+
+    def __init__(self, id: str, area: str, store: "DatasetStore", offset: int, length: int) -> None:
+        self.id = id
+        self.area = area
+        self._store = store
+        self._offset = offset
+        self._length = length
+        self._data = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            self._data = self._store.read_record(self._offset, self._length)
+        return self._data
+
+    @property
+    def prompt_prefix(self) -> str:
+        """the part of the prompt shared with other questions (empty if none), e.g., for provider prompt caching"""
+        prefix_index = self._load().get("prompt_prefix")
+        return self._store.prompt_prefixes[prefix_index] if prefix_index is not None else ""
+
+    def __getitem__(self, key: str):
+        if key == "id":
+            return self.id
+        if key == "area":
+            return self.area
+        if key == "prompt":
+            return self.prompt_prefix + self._load()["prompt"]
+        if key == "prompt_prefix":
+            raise KeyError(key)
+        return self._load()[key]
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return key in ("id", "area") or key in self.keys()
+
+    def keys(self):
+        return [key for key in self._load().keys() if key != "prompt_prefix"]
+
+    def to_dict(self) -> dict:
+        return {key: self[key] for key in self.keys()}
+
+    def __repr__(self) -> str:
+        return f"Question(id={self.id!r}, area={self.area!r})"
+
+
+class DatasetStore:
+    """Read-only view of a compiled dataset (see compile_dataset), memory mapped.
+
+    Only the index (ids, areas and offsets) is parsed when opening, each question is parsed when it is used.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a compiled dataset")
+        (index_length,) = INDEX_LENGTH.unpack_from(self.mmap, len(MAGIC))
+        index_start = len(MAGIC) + INDEX_LENGTH.size
+        self.index = json.loads(self.mmap[index_start : index_start + index_length].decode("utf-8"))
+        self.records_start = index_start + index_length
+        self.prompt_prefixes: list[str] = self.index["prompt_prefixes"]
+
+        # the questions are kept in the order of the original dataset
+        self.questions = {
+            id: Question(id, area, self, offset, length) for id, area, offset, length in self.index["questions"]
+        }
+        self.ids_by_area: dict[str, list[str]] = {}
+        for question in self.questions.values():
+            self.ids_by_area.setdefault(question.area, []).append(question.id)
+
+    def read_record(self, offset: int, length: int) -> dict:
+        start = self.records_start + offset
+        return json.loads(self.mmap[start : start + length].decode("utf-8"))
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def __getitem__(self, id: str) -> Question:
+        return self.questions[id]
+
+    def get_area(self, area: str) -> dict[str, Question]:
+        return {id: self.questions[id] for id in self.ids_by_area.get(area, [])}
+
+
+def get_source_signature(source_path: str) -> list[int]:
+    stat = os.stat(source_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_compiled_path(source_path: str) -> str:
+    """dataset/enem/x.json is compiled to dataset/enem/.cache/x.store"""
+    source_dir, source_filename = os.path.split(source_path)
+    return os.path.join(source_dir, ".cache", os.path.splitext(source_filename)[0] + ".store")
+
+
+def compile_dataset(source_path: str, compiled_path: str | None = None) -> str:
+    """Compiles a json dataset (a list of questions with, at least, id and area) into the indexed format"""
+    if compiled_path is None:
+        compiled_path = get_compiled_path(source_path)
+    with open(source_path, "r", encoding="utf-8") as f:
+        dataset = json.load(f)
+
+    prompt_prefixes = []
+    questions = []
+    records = []
+    offset = 0
+    for question in dataset:
+        question = dict(question)
+        # the longest shared prefix is stored once, the record keeps its index and the rest of the prompt
+        prefixes = [prefix for prefix in SHARED_PROMPT_PREFIXES if question.get("prompt", "").startswith(prefix)]
+        if len(prefixes) > 0:
+            prefix = max(prefixes, key=len)
+            if prefix not in prompt_prefixes:
+                prompt_prefixes.append(prefix)
+            question["prompt_prefix"] = prompt_prefixes.index(prefix)
+            question["prompt"] = question["prompt"][len(prefix) :]
+        record = json.dumps(question, ensure_ascii=False).encode("utf-8")
+        questions.append([question["id"], question["area"], offset, len(record)])
+        records.append(record)
+        offset += len(record)
+    assert len({id for id, *_ in questions}) == len(questions), f"{source_path} has repeated question ids"
+
+    index = json.dumps(
+        dict(source_signature=get_source_signature(source_path), prompt_prefixes=prompt_prefixes, questions=questions),
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+    os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+    tmp_path = f"{compiled_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(INDEX_LENGTH.pack(len(index)))
+        f.write(index)
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, compiled_path)  # other processes never see a partial file
+    return compiled_path
+
+
+@cache
+def _open_dataset_store(compiled_path: str, source_signature: tuple[int, int]) -> DatasetStore:
+    return DatasetStore(compiled_path)
+
+
+def open_dataset(source_path: str) -> DatasetStore:
+    """Opens the compiled version of a json dataset, compiling it first if it is missing or outdated.
+
+    The store is opened once per process and shared by the callers.
+    """
+    compiled_path = get_compiled_path(source_path)
+    source_signature = get_source_signature(source_path)
+    if os.path.exists(compiled_path):
+        try:
+            store = _open_dataset_store(compiled_path, tuple(source_signature))
+            if store.index["source_signature"] == source_signature:
+                return store
+        except ValueError:
+            pass  # not a compiled dataset (e.g., an older format), compiled again below
+        _open_dataset_store.cache_clear()
+    compile_dataset(source_path, compiled_path)
+    return _open_dataset_store(compiled_path, tuple(source_signature))
+
+
+if __name__ == "__main__":
+    import fire
+
+    # e.g., python dataset_store.py ../dataset/enem/enem_2022_3_shot.json
+    fire.Fire(compile_dataset)
@@ -1,15 +1,43 @@
 import os
 import re
+import math
 import json
+import glob
+import asyncio
 import fire
+import numpy as np
 from chat_completion_wrapper import (
     OpenAIChatCompletionWrapper,
     HFLlama2ChatCompletionWrapper,
     HFFalconChatCompletionWrapper,
     MariTalkChatCompletionWrapper,
+    ResponseCache,
+    configure_rate_limit,
+    OPENAI_RATE_LIMITS,
+    configure_hedging,
+    get_http_transport,
+    get_metrics_recorder,
+    metric_labels,
+    get_choice_probabilities,
 )
+from chat_completion_wrapper.metrics import get_quantile
+from chat_completion_wrapper.openai_chat_completion_wrapper import DEFAULT_GENERATION_PARAMS as OPENAI_GENERATION_PARAMS
 from tqdm import tqdm
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from grid_scheduler import CellProgress, run_grid
+from dataset_store import open_dataset
+from logger import logger
+from report_arrays import (
+    AREAS,
+    load_report_arrays,
+    load_correctness_matrix,
+    load_report_accuracies,
+    get_bootstrap_intervals,
+    get_stratified_order,
+    get_stratified_interval,
+)
 
 AREA_MAP = {
     "languages": "Languages and Codes",
@@ -24,6 +52,25 @@ DATASET_TO_FILENAME = {
     "Few-shot with Chain-of-Thought": "enem_cot_2022_3_shot.json",
 }
 
+# processes used by each provider when evaluating a grid of models and datasets
+DEFAULT_MAX_WORKERS_PER_PROVIDER = {
+    "openai": 2,
+    "huggingface": 1,
+    "maritalk": 1,
+}
+
+# an answer letter, optionally followed by a dot. The last "X." is the answer, otherwise the last letter (zero-shot)
+ANSWER_PATTERN = re.compile(r"([ABCDE])(\.)?")
+
+REPORTS_DIR = os.path.join("..", "reports")
+
+# how the answers are obtained: the generated answer, the most likely letter from the log probabilities of a single
+# output token (only for the datasets without chain-of-thought, see score_choices of the wrappers), or the majority
+# vote of several sampled answers (self-consistency, see sample of the wrappers)
+SCORINGS = ("generation", "logprobs", "self-consistency")
+
+ANSWER_LETTERS = ["A.", "B.", "C.", "D.", "E."]
+
 DATASET_TO_TITLE = {
     "Zero-shot": "zero-shot",
     "Few-shot": "three-shot",
@@ -31,10 +78,10 @@ DATASET_TO_TITLE = {
 }
 
 
-def get_llm(model):
+def get_llm(model, cache: ResponseCache | None = None):
     if model.startswith("gpt-3.5-turbo") or model.startswith("gpt-4"):
         assert "OPENAI_API_KEY" in os.environ, "You need to set OPENAI_API_KEY in your environment variable."
-        llm = OpenAIChatCompletionWrapper(model=model, log=False)
+        llm = OpenAIChatCompletionWrapper(model=model, log=False, cache=cache)
     elif model.startswith("LLaMA-2"):
         llm = HFLlama2ChatCompletionWrapper(
             endpoint_url=os.environ[f"huggingface_{model.replace('-', '')}_url"],
@@ -42,6 +89,8 @@ def get_llm(model):
             namespace=os.environ["huggingface_namespace"],
             name=os.environ[f"huggingface_{model.replace('-', '')}_name"],
             log=False,
+            cache=cache,
+            tokenizer_path=os.environ.get(f"huggingface_{model.replace('-', '')}_tokenizer_path"),
         )
     elif model.startswith("Falcon"):
         llm = HFFalconChatCompletionWrapper(
@@ -50,124 +99,803 @@ def get_llm(model):
             namespace=os.environ["huggingface_namespace"],
             name=os.environ[f"huggingface_{model.replace('-', '')}_name"],
             log=False,
+            cache=cache,
+            tokenizer_path=os.environ.get(f"huggingface_{model.replace('-', '')}_tokenizer_path"),
         )
     elif model == "MariTalk":
-        llm = MariTalkChatCompletionWrapper(log=False)
+        llm = MariTalkChatCompletionWrapper(log=False, cache=cache)
     else:
         raise ValueError(f"Model {model} is not available.")
 
     return llm
 
 
-def format_enem_dataset(dataset: list[dict]) -> dict:
-    """return the list of dicts into a data dict splitting by area and then by id"""
+def wake_endpoints(models: list[str]):
+    """Wakes up the Hugging Face endpoints of the models (e.g., scaled to zero), so they start at the same time
 
-    new_dataset = {}
-    for d in dataset:
-        area = AREA_MAP[d["area"]]
-        if area not in new_dataset:
-            new_dataset[area] = {}
-        assert d["id"] not in new_dataset[area]
-        new_dataset[area][d["id"]] = d
+    The evaluation does not need it, the requests wait for the endpoints to be running, but it saves the waiting
+    time of the endpoints evaluated after the first one.
 
-    return new_dataset
+    Args:
+        models (list[str]): List of LLMs, the ones not served by Hugging Face endpoints are ignored.
+    """
+    if isinstance(models, str):
+        models = [models]
+    for model in models:
+        if get_provider(model) == "huggingface":
+            get_llm(model).endpoint_manager.wake()
+
+
+def get_provider(model):
+    if model.startswith("gpt-3.5-turbo") or model.startswith("gpt-4"):
+        return "openai"
+    elif model.startswith("LLaMA-2") or model.startswith("Falcon"):
+        return "huggingface"
+    elif model == "MariTalk":
+        return "maritalk"
+    raise ValueError(f"Model {model} is not available.")
+
+
+def configure_rate_limits(rate_limits: dict[str, dict] | str | None) -> None:
+    """e.g., {"gpt-4": {"rpm": 500, "tpm": 80000}}, by model or model prefix, or "openai" for OPENAI_RATE_LIMITS"""
+    if rate_limits == "openai":
+        rate_limits = OPENAI_RATE_LIMITS
+    for model, limits in (rate_limits or {}).items():
+        configure_rate_limit(get_provider(model), model, **limits)
+
+
+def configure_hedging_policies(hedging: dict[str, dict] | None) -> None:
+    """e.g., {"gpt-4": {"quantile": 0.95, "max_hedge_ratio": 0.05}}, by model or model prefix, see HedgingPolicy"""
+    for model, kwargs in (hedging or {}).items():
+        configure_hedging(get_provider(model), model, **kwargs)
+
+
+def extract_answer(answer: str) -> str | None:
+    """returns the answer letter as "X.", or None if there is no letter in the answer"""
+    last_letter = None
+    last_letter_with_dot = None
+    for match in ANSWER_PATTERN.finditer(answer):
+        last_letter = match.group(1)
+        if match.group(2) is not None:
+            last_letter_with_dot = last_letter
+    if last_letter_with_dot is not None:
+        return last_letter_with_dot + "."
+    if last_letter is not None:
+        return last_letter + "."
+    return None
 
 
 def get_formatted_answer(question, answer):
-    gold = ["A.", "B.", "C.", "D.", "E."][question["gold"]]
-    pred = answer
+    gold = ANSWER_LETTERS[question["gold"]]
 
     # regex processing. Useful for zero-shot
-    match_1 = re.findall(r"(?:|[Ll]etra |[Aa]lternativa )([ABCDE])\.", pred)
-    match_2 = re.findall(r"(?:|[Ll]etra |[Aa]lternativa )([ABCDE])", pred)
-    if len(match_1) > 0:
-        pred = match_1[-1] + "."
-    elif len(match_2) > 0:
-        pred = match_2[-1] + "."
-    else:
-        print(f"Regex failed at processing {pred=}")
-        print(f"{gold=}, {pred=}")
+    pred = extract_answer(answer)
+    if pred is None:
+        pred = answer
+        logger(observation="Regex failed at processing the answer", content=f"{gold=}, {pred=}")
 
     return pred, gold
 
 
+def answer_is_decided(answer: str) -> bool:
+    """early stop for zero-shot and few-shot, the first "X." is taken as the answer"""
+    return re.search(r"(?:|[Ll]etra |[Aa]lternativa )([ABCDE])\.", answer) is not None
+
+
+def cot_answer_is_decided(answer: str) -> bool:
+    """early stop for chain-of-thought, the explanation ends with "Resposta: X." (see prompt_builder.py)"""
+    return re.search(r"Resposta: ?([ABCDE])\.", answer) is not None
+
+
+def get_early_stop_predicate(dataset_name):
+    if dataset_name == "Few-shot with Chain-of-Thought":
+        return cot_answer_is_decided
+    return answer_is_decided
+
+
 def get_dataset(dataset_name):
+    """return the questions split by area and then by id. They are read lazily from the compiled dataset"""
     filename = DATASET_TO_FILENAME[dataset_name]
-    with open(os.path.join(Path(__file__).parent.parent.resolve(), "dataset", "enem", filename), "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return format_enem_dataset(data)
+    store = open_dataset(os.path.join(Path(__file__).parent.parent.resolve(), "dataset", "enem", filename))
+    return {AREA_MAP[area]: store.get_area(area) for area in store.ids_by_area}
+
+
+def get_report_item(question, answer):
+    pred, gold = get_formatted_answer(question, answer)
+    return dict(
+        id=question["id"],
+        response=answer,
+        pred=pred,
+        gold=gold,
+        area=question["area"],
+    )
+
+
+def get_scored_report_item(question, choice_logprobs: dict[str, float | None]):
+    """report item of the logprobs scoring, the answer is the most likely letter and choice_probs the distribution
+    over the letters. The answer is empty (wrong) when no letter is among the most likely tokens"""
+    choice_probs = get_choice_probabilities(choice_logprobs)
+    answer = "" if max(choice_probs.values()) == 0 else f"{max(choice_probs, key=choice_probs.get)}."
+    return dict(get_report_item(question, answer), choice_probs=choice_probs)
+
+
+def get_vote(preds: list[str]) -> tuple[str, float]:
+    """the most frequent answer letter (the first one given in a tie) and the fraction of the samples that gave it,
+    ("", 0) when no sample has a letter"""
+    votes = Counter(pred for pred in preds if pred in ANSWER_LETTERS)
+    if len(votes) == 0:
+        return "", 0.0
+    pred, count = votes.most_common(1)[0]
+    return pred, count / len(preds)
+
+
+def get_voted_report_item(question, samples: list[str]):
+    """report item of self-consistency, the answer is the vote of the samples and agreement its share of them"""
+    sample_preds = [get_formatted_answer(question, sample)[0] for sample in samples]
+    pred, agreement = get_vote(sample_preds)
+    return dict(get_report_item(question, pred), samples=samples, sample_preds=sample_preds, agreement=agreement)
+
+
+def get_report_model(model, scoring="generation"):
+    """the reports of the other scorings are kept apart, e.g., gpt-4-0613-logprobs_enem_2022_0_shot.json, so
+    build_results_table can compare them with the generated answers"""
+    return model if scoring == "generation" else f"{model}-{scoring}"
+
+
+def get_report_path(model, dataset_name, reports_dir=REPORTS_DIR):
+    return os.path.join(reports_dir, f"{model}_{DATASET_TO_FILENAME[dataset_name]}")
+
+
+def get_token_budget(llm, model, dataset_name, reports_dir=REPORTS_DIR, quantile: float = 0.99, margin: int = 32):
+    """max tokens of the first attempt of each answer: a quantile of the token lengths of the responses in the previous
+    report of the model on the dataset, plus a margin. The answers cut by it are generated again with the full max
+    tokens. None (the full max tokens) when there is no report yet. The responses of a report evaluated with
+    early_stop are shorter than the whole answers"""
+    report_path = get_report_path(model, dataset_name, reports_dir)
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    length = get_quantile([llm.token_counter.count(item["response"]) for item in report], quantile)
+    return None if length is None else math.ceil(length) + margin
+
+
+def get_metrics_path(report_path):
+    """the metrics of the requests (time, tokens, retries and cost) are a json sidecar of the report"""
+    return os.path.splitext(report_path)[0] + ".metrics.json"
+
+
+def get_metrics_model(llm, model):
+    """the wrappers record the metrics of the Hugging Face models under the endpoint name"""
+    return llm.name if get_provider(model) == "huggingface" else model
+
+
+def get_checkpoint_path(report_path):
+    """the checkpoint is a jsonl sidecar of the report, with one report item per line"""
+    return os.path.splitext(report_path)[0] + ".jsonl"
+
+
+def load_checkpoint(checkpoint_path) -> dict:
+    """return the report items already on disk, by question id"""
+    items = {}
+    if not os.path.exists(checkpoint_path):
+        return items
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                break  # the last line may be incomplete if the process was killed while writing it
+            items[item["id"]] = item
+    return items
+
+
+def write_checkpoint_item(checkpoint_file, item: dict) -> None:
+    checkpoint_file.write(json.dumps(item, ensure_ascii=False) + "\n")
+    checkpoint_file.flush()
+
+
+def answer_question(llm, question, llm_kwargs: dict, scoring: str = "generation") -> dict:
+    """the report item of a question, see SCORINGS"""
+    if scoring == "logprobs":
+        return get_scored_report_item(question, llm.score_choices(question["prompt"]))
+    if scoring == "self-consistency":
+        return get_voted_report_item(question, llm.sample(question["prompt"], **llm_kwargs))
+    llm.new_session()
+    return get_report_item(question, llm(question["prompt"], **llm_kwargs))
+
+
+async def aanswer_question(llm, question, llm_kwargs: dict, scoring: str = "generation") -> dict:
+    if scoring == "logprobs":
+        return get_scored_report_item(question, await llm.ascore_choices(question["prompt"]))
+    if scoring == "self-consistency":
+        return get_voted_report_item(question, await llm.asample(question["prompt"], **llm_kwargs))
+    return get_report_item(question, await llm.acall(question["prompt"], **llm_kwargs))
+
+
+def evaluate_dataset(
+    llm,
+    dataset: dict,
+    checkpoint_file,
+    done_ids: set,
+    llm_kwargs: dict,
+    progress: CellProgress | None = None,
+    scoring: str = "generation",
+) -> None:
+    """answers the questions one at a time, in the dataset order, appending each result to the checkpoint"""
+    for area, questions_by_area in dataset.items():
+        for question in tqdm(
+            questions_by_area.values(), desc=f"Evaluating area {area}", leave=False, disable=progress is not None
+        ):
+            assert area == AREA_MAP[question["area"]]
+            if question["id"] in done_ids:
+                continue
+            write_checkpoint_item(checkpoint_file, answer_question(llm, question, llm_kwargs, scoring))
+            if progress is not None:
+                progress.update()
+            # break  # only to test, remove after testing
+
+
+async def aevaluate_dataset(
+    llm,
+    dataset: dict,
+    concurrency: int,
+    checkpoint_file,
+    done_ids: set,
+    llm_kwargs: dict,
+    progress: CellProgress | None = None,
+    scoring: str = "generation",
+) -> None:
+    """answers up to `concurrency` questions at the same time, appending each result to the checkpoint as it finishes"""
+    questions = []
+    for area, questions_by_area in dataset.items():
+        for question in questions_by_area.values():
+            assert area == AREA_MAP[question["area"]]
+            if question["id"] not in done_ids:
+                questions.append(question)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    progress_bar = tqdm(
+        total=len(questions), desc=f"Evaluating {concurrency} at a time", leave=False, disable=progress is not None
+    )
+
+    async def evaluate_question(question):
+        async with semaphore:
+            item = await aanswer_question(llm, question, llm_kwargs, scoring)
+        write_checkpoint_item(checkpoint_file, item)
+        progress_bar.update()
+        if progress is not None:
+            progress.update()
+
+    try:
+        await asyncio.gather(*[evaluate_question(question) for question in questions])
+    finally:
+        progress_bar.close()
+        await get_http_transport().aclose()  # the pooled connections of this event loop
+
+
+def load_baseline_correct(baseline: str, dataset_name, dataset: dict, reports_dir=REPORTS_DIR) -> np.ndarray:
+    """whether the baseline answered each question of the dataset correctly, in the order of the dataset. The paired
+    difference is estimated over all the questions, so the report can't be partial (e.g., of an adaptive run)"""
+    questions = [question for questions_by_area in dataset.values() for question in questions_by_area.values()]
+    baseline_path = get_report_path(baseline, dataset_name, reports_dir)
+    if not os.path.exists(baseline_path):
+        raise ValueError(f"There is no report of the baseline {baseline} on {dataset_name} ({baseline_path})")
+    arrays = load_report_arrays(baseline_path)
+    correct_by_id = dict(zip(arrays["ids"], arrays["correct"]))
+    missing = [question["id"] for question in questions if question["id"] not in correct_by_id]
+    if len(missing) > 0:
+        raise ValueError(
+            f"The report of the baseline {baseline} on {dataset_name} misses {len(missing)} of the "
+            f"{len(questions)} questions (e.g., {missing[0]}), the baseline must have answered all of them"
+        )
+    return np.array([correct_by_id[question["id"]] for question in questions], dtype=float)
+
+
+def evaluate_adaptively(
+    llm,
+    dataset_name,
+    dataset: dict,
+    concurrency: int,
+    checkpoint_file,
+    done: dict,
+    llm_kwargs: dict,
+    scoring: str = "generation",
+    reports_dir=REPORTS_DIR,
+    progress: CellProgress | None = None,
+    width: float = 0.1,
+    confidence: float = 0.95,
+    baseline: str | None = None,
+    min_questions: int = 40,
+    seed: int = 0,
+) -> dict:
+    """Answers the questions in a stratified random order (see get_stratified_order) until the confidence interval of
+    the accuracy, or of the paired difference of accuracy with the report of a baseline on the same questions, is
+    narrower than width. The questions in flight when it is reached are kept.
+
+    The interval is not widened for being checked after each answer, so it is meant for quick comparisons, not for the
+    published results.
+
+    Args:
+        width (float): target width of the interval, e.g., 0.1 for +-5 points. Defaults to 0.1.
+        confidence (float): confidence level of the interval. Defaults to 0.95.
+        baseline (str | None): model name of the report in reports_dir to compare with, e.g., "gpt-4-0613" or
+            "gpt-4-0613-logprobs". Defaults to None (the interval of the accuracy).
+        min_questions (int): questions answered before stopping. Defaults to 40.
+        seed (int): seed of the order of the questions. Defaults to 0.
+
+    Returns:
+        dict: the estimate (accuracy or difference), its interval and the number of questions answered.
+    """
+    questions = [question for questions_by_area in dataset.values() for question in questions_by_area.values()]
+    areas = np.array([AREAS.index(question["area"]) for question in questions])
+    baseline_correct = np.zeros(len(questions))
+    if baseline is not None:
+        baseline_correct = load_baseline_correct(baseline, dataset_name, dataset, reports_dir)
+    bounds = (0.0, 1.0) if baseline is None else (-1.0, 1.0)
+    values = np.zeros(len(questions))
+    answered = np.zeros(len(questions), dtype=bool)
+
+    def add(index: int, item: dict) -> None:
+        values[index] = (item["pred"] == item["gold"]) - baseline_correct[index]
+        answered[index] = True
+
+    def get_interval() -> tuple[float, float, float]:
+        return get_stratified_interval(values, areas, answered, confidence, bounds)
+
+    def is_precise() -> bool:
+        _, lower, upper = get_interval()
+        return answered.sum() >= min_questions and upper - lower <= width
+
+    index_by_id = {question["id"]: index for index, question in enumerate(questions)}
+    for question_id, item in done.items():
+        add(index_by_id[question_id], item)
+    order = [index for index in get_stratified_order(areas, seed) if not answered[index]]
+
+    progress_bar = tqdm(
+        total=len(questions), initial=len(done), desc="Evaluating adaptively", leave=False, disable=progress is not None
+    )
+
+    def answered_question(index: int, item: dict) -> None:
+        write_checkpoint_item(checkpoint_file, item)
+        add(index, item)
+        _, lower, upper = get_interval()
+        progress_bar.set_postfix(width=f"{upper - lower:.3f}")
+        progress_bar.update()
+        if progress is not None:
+            progress.update()
+
+    async def aanswer_until_precise() -> None:
+        pending = iter(order)  # shared by the workers, each one takes the next question
+
+        async def worker() -> None:
+            for index in pending:
+                if is_precise():
+                    return
+                answered_question(index, await aanswer_question(llm, questions[index], llm_kwargs, scoring))
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        finally:
+            await get_http_transport().aclose()
+
+    try:
+        if concurrency == 1:
+            for index in order:
+                if is_precise():
+                    break
+                answered_question(index, answer_question(llm, questions[index], llm_kwargs, scoring))
+        else:
+            asyncio.run(aanswer_until_precise())
+    finally:
+        progress_bar.close()
+
+    estimate, lower, upper = get_interval()
+    return dict(
+        metric="accuracy" if baseline is None else "paired_difference",
+        baseline=baseline,
+        estimate=estimate,
+        lower=lower,
+        upper=upper,
+        confidence=confidence,
+        target_width=width,
+        reached=upper - lower <= width,
+        questions=int(answered.sum()),
+        total_questions=len(questions),
+    )
+
+
+def build_report(dataset: dict, checkpoint_path, partial: bool = False) -> list[dict]:
+    """the report follows the dataset order, whatever the order the answers were written to the checkpoint.
+    A partial report (adaptive evaluation) only has the answered questions"""
+    items = load_checkpoint(checkpoint_path)
+    return [
+        items[question["id"]]
+        for questions_by_area in dataset.values()
+        for question in questions_by_area.values()
+        if not partial or question["id"] in items
+    ]
+
+
+def evaluate_model_on_dataset(
+    llm,
+    model,
+    dataset_name,
+    concurrency: int = 1,
+    resume: bool = False,
+    early_stop: bool = False,
+    reports_dir=REPORTS_DIR,
+    metrics_path: str | None = None,
+    scoring: str = "generation",
+    token_budget: dict | None = None,
+    n_samples: int = 5,
+    sampling_temperature: float = 0.7,
+    adaptive: dict | None = None,
+    progress: CellProgress | None = None,
+) -> None:
+    """writes the report of one model on one dataset, and the metrics of its requests next to it"""
+    dataset = get_dataset(dataset_name)
+    llm_kwargs = dict(stop_when=get_early_stop_predicate(dataset_name)) if early_stop else {}
+    if scoring == "self-consistency":
+        llm_kwargs = dict(n=n_samples, temperature=sampling_temperature)
+    if token_budget is not None and scoring == "generation":
+        # from the previous report, before it is overwritten
+        llm_kwargs["token_budget"] = get_token_budget(llm, model, dataset_name, reports_dir, **token_budget)
+    report_model = get_report_model(model, scoring)
+    if adaptive is not None:
+        # only part of the questions, kept apart from the complete reports
+        report_model = f"{report_model}-adaptive"
+    report_path = get_report_path(report_model, dataset_name, reports_dir)
+    checkpoint_path = get_checkpoint_path(report_path)
+
+    done = load_checkpoint(checkpoint_path) if resume else {}
+    metrics_snapshot = get_metrics_recorder().snapshot()
+    if progress is not None:
+        progress.set_total(sum(len(questions_by_area) for questions_by_area in dataset.values()))
+        progress.update(len(done))
+
+    with open(checkpoint_path, "w", encoding="utf-8") as checkpoint_file, metric_labels(dataset=dataset_name):
+        # rewriting what was kept drops a possibly incomplete last line
+        for item in done.values():
+            write_checkpoint_item(checkpoint_file, item)
+
+        summary = None
+        if adaptive is not None:
+            summary = evaluate_adaptively(
+                llm,
+                dataset_name,
+                dataset,
+                concurrency,
+                checkpoint_file,
+                done,
+                llm_kwargs,
+                scoring=scoring,
+                reports_dir=reports_dir,
+                progress=progress,
+                **adaptive,
+            )
+            tqdm.write(f"{report_model} {dataset_name}: {json.dumps(summary)}")
+        elif concurrency == 1:
+            evaluate_dataset(llm, dataset, checkpoint_file, set(done), llm_kwargs, progress, scoring)
+        else:
+            asyncio.run(
+                aevaluate_dataset(llm, dataset, concurrency, checkpoint_file, set(done), llm_kwargs, progress, scoring)
+            )
+
+    report = build_report(dataset, checkpoint_path, partial=adaptive is not None)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    os.remove(checkpoint_path)
+
+    # only the requests of this run, not the ones of an interrupted run (resume) or of an earlier evaluate in the process
+    metrics = get_metrics_recorder().summary(
+        since=metrics_snapshot, model=get_metrics_model(llm, model), dataset=dataset_name
+    )
+    with open(get_metrics_path(report_path), "w", encoding="utf-8") as f:
+        json.dump(dict(metrics, token_budget=llm_kwargs.get("token_budget"), adaptive=summary), f, indent=4)
+    if metrics_path is not None:
+        get_metrics_recorder().write_prometheus(metrics_path)
+
+
+def evaluate_grid_cell(model, dataset_name, setup: dict, options: dict, progress: CellProgress) -> None:
+    """runs in a worker process of the grid scheduler
+
+    Args:
+        setup (dict): cache_path, replay, rate_limits and hedging, see evaluate.
+        options (dict): keyword arguments of evaluate_model_on_dataset.
+    """
+    configure_rate_limits(setup["rate_limits"])
+    configure_hedging_policies(setup["hedging"])
+    cache = None if setup["cache_path"] is None else ResponseCache(setup["cache_path"], replay=setup["replay"])
+    llm = get_llm(model, cache=cache)
+    if options["metrics_path"] is not None:
+        # each worker process has its own metrics, e.g., metrics.prom -> metrics.1234.prom
+        root, ext = os.path.splitext(options["metrics_path"])
+        options = dict(options, metrics_path=f"{root}.{os.getpid()}{ext}")
+    evaluate_model_on_dataset(llm, model, dataset_name, progress=progress, **options)
 
 
 def evaluate(
     models: list[str] = ["gpt-3.5-turbo-0613", "gpt-4-0613"],
     dataset_names: list[str] = ["Zero-shot", "Few-shot", "Few-shot with Chain-of-Thought"],
+    concurrency: int = 1,
+    cache_path: str | None = None,
+    replay: bool = False,
+    resume: bool = False,
+    grid: bool = False,
+    max_workers_per_provider: dict[str, int] = DEFAULT_MAX_WORKERS_PER_PROVIDER,
+    rate_limits: dict[str, dict] | str | None = None,
+    hedging: dict[str, dict] | None = None,
+    early_stop: bool = False,
+    reports_dir: str = REPORTS_DIR,
+    metrics_path: str | None = None,
+    scoring: str = "generation",
+    token_budget: dict | None = None,
+    n_samples: int = 5,
+    sampling_temperature: float = 0.7,
+    adaptive: dict | None = None,
 ):
     """Evaluates LLMs on Enem
 
     Args:
         models (list[str]): List of LLMs. Defaults to "['gpt-3.5-turbo-0613', 'gpt-4-0613']".
         dataset_names (list[str]): List of dataset names. Defaults to "['Zero-shot', 'Few-shot', 'Few-shot with Chain-of-Thought']".
+        concurrency (int): Number of in-flight requests per model. Defaults to 1 (one question at a time).
+        cache_path (str | None): sqlite file to cache the responses, so a rerun only pays for new requests. Defaults to None (no cache).
+        replay (bool): only use the responses from the cache, failing on a cache miss. Defaults to False.
+        resume (bool): skip the questions already answered in the checkpoint of an interrupted run. Defaults to False.
+        grid (bool): evaluate each (model, dataset) in its own process instead of one after another. Defaults to False.
+        max_workers_per_provider (dict[str, int]): Number of processes of each provider when grid is set. Defaults to "{'openai': 2, 'huggingface': 1, 'maritalk': 1}".
+        rate_limits (dict[str, dict] | str | None): Requests and tokens per minute by model (or model prefix), e.g., "{'gpt-4': {'rpm': 500, 'tpm': 80000}}", or "openai" for the default limits of an OpenAI account. Defaults to None (no limits). With grid, the limits apply to each process.
+        hedging (dict[str, dict] | None): send a duplicate of the requests slower than a quantile of the recent latencies and take the first answer, by model (or model prefix), e.g., "{'gpt-4': {'quantile': 0.95, 'max_hedge_ratio': 0.05}}" (see HedgingPolicy, {} for the defaults). Defaults to None (no hedging).
+        early_stop (bool): stream the answers and stop the generation as soon as the answer letter is given. Defaults to False.
+        reports_dir (str): folder of the reports. Defaults to "../reports".
+        metrics_path (str | None): file updated with the metrics of the requests in the Prometheus text format after each dataset, e.g., for the textfile collector of the node exporter. With grid, one file per process (metrics.<pid>.prom). Defaults to None (only the <report>.metrics.json summaries).
+        scoring (str): "generation" to generate the answers, "logprobs" to take the most likely letter of a single output token and store the distribution over A-E in the report (choice_probs), or "self-consistency" to take the majority vote of n_samples sampled answers and store the samples and the agreement of the vote in the report. The reports are written under the model name <model>-<scoring>. logprobs is only for the Zero-shot and Few-shot datasets, not for MariTalk. Defaults to "generation".
+        token_budget (dict | None): generate the answers with a max tokens learned from the previous report of each model and dataset, the quantile of the response lengths plus a margin, e.g., "{'quantile': 0.99, 'margin': 32}" ({} for these defaults). The answers cut by it (finish_reason length) are generated again with the full max tokens. Defaults to None (always the full max tokens).
+        n_samples (int): answers sampled for each question with self-consistency, in a single request for OpenAI and in concurrent requests for the others. Defaults to 5.
+        sampling_temperature (float): temperature of the self-consistency samples. Defaults to 0.7.
+        adaptive (dict | None): answer the questions in a random order balanced by area, and stop once the confidence interval of the accuracy, or of the paired difference with the report of a baseline model, is narrower than width, e.g., "{'width': 0.1}" or "{'width': 0.1, 'baseline': 'gpt-4-0613'}" (see evaluate_adaptively). The partial reports are written under the model name <model>-adaptive, with the estimate in their metrics. Defaults to None (all the questions).
     """
+    assert concurrency >= 1, "concurrency should be at least 1"
+    assert not replay or cache_path is not None, "replay needs a cache_path"
+    assert scoring in SCORINGS, f"scoring should be one of {SCORINGS}"
+    if scoring == "logprobs":
+        assert "Few-shot with Chain-of-Thought" not in dataset_names, "the chain-of-thought answers must be generated"
+        assert "MariTalk" not in models, "MariTalk returns no log probabilities"
+        assert not early_stop and token_budget is None, "the scores are a single token, not streamed nor within a budget"
+    if scoring == "self-consistency":
+        assert n_samples >= 1, "n_samples should be at least 1"
+        assert not early_stop and token_budget is None, "the samples are not streamed nor generated within a budget"
+    if adaptive is not None and adaptive.get("baseline") is not None:
+        # before any question is answered
+        for dataset_name in dataset_names:
+            load_baseline_correct(adaptive["baseline"], dataset_name, get_dataset(dataset_name), reports_dir)
+
+    options = dict(
+        concurrency=concurrency,
+        resume=resume,
+        early_stop=early_stop,
+        reports_dir=reports_dir,
+        metrics_path=metrics_path,
+        scoring=scoring,
+        token_budget=token_budget,
+        n_samples=n_samples,
+        sampling_temperature=sampling_temperature,
+        adaptive=adaptive,
+    )
+    if not replay:
+        wake_endpoints(models)
+
+    if grid:
+        setup = dict(cache_path=cache_path, replay=replay, rate_limits=rate_limits, hedging=hedging)
+        run_grid(
+            cells=[(model, dataset_name, setup, options) for model in models for dataset_name in dataset_names],
+            worker=evaluate_grid_cell,
+            get_provider=lambda cell: get_provider(cell[0]),
+            max_workers_per_provider=max_workers_per_provider,
+            get_description=lambda cell: f"{cell[0]} {cell[1]}",
+        )
+        return
+
+    configure_rate_limits(rate_limits)
+    configure_hedging_policies(hedging)
+    cache = None if cache_path is None else ResponseCache(cache_path, replay=replay)
+
     # getting anwers
     for model in tqdm(models, desc="Evaluating all"):
-        llm = get_llm(model)
+        llm = get_llm(model, cache=cache)
         for dataset_name in tqdm(dataset_names, desc=f"Evaluating model {model}", leave=False):
-            dataset = get_dataset(dataset_name)
-            report = []
-            for area, questions_by_area in dataset.items():
-                for question in tqdm(questions_by_area.values(), desc=f"Evaluating area {area}", leave=False):
-                    assert area == AREA_MAP[question["area"]]
-                    llm.new_session()
-                    answer = llm(question["prompt"])
-                    pred, gold = get_formatted_answer(question, answer)
-                    report.append(
-                        dict(
-                            id=question["id"],
-                            response=answer,
-                            pred=pred,
-                            gold=gold,
-                            area=question["area"],
+            evaluate_model_on_dataset(llm, model, dataset_name, **options)
+
+
+def get_batch_custom_id(model, dataset_name, question_id):
+    return f"{model}/{Path(DATASET_TO_FILENAME[dataset_name]).stem}/{question_id}"
+
+
+def parse_batch_custom_id(custom_id):
+    model, dataset_stem, question_id = custom_id.rsplit("/", 2)
+    dataset_name = {Path(filename).stem: name for name, filename in DATASET_TO_FILENAME.items()}[dataset_stem]
+    return model, dataset_name, question_id
+
+
+def export_batch(
+    models: list[str] = ["gpt-3.5-turbo-0613", "gpt-4-0613"],
+    dataset_names: list[str] = ["Zero-shot", "Few-shot", "Few-shot with Chain-of-Thought"],
+    output_dir: str = os.path.join("..", "batch"),
+):
+    """Writes the requests of the evaluation in the OpenAI batch format, one file per model
+
+    Args:
+        models (list[str]): List of LLMs. Defaults to "['gpt-3.5-turbo-0613', 'gpt-4-0613']".
+        dataset_names (list[str]): List of dataset names. Defaults to "['Zero-shot', 'Few-shot', 'Few-shot with Chain-of-Thought']".
+        output_dir (str): Where to write the {model}.jsonl files. Defaults to "../batch".
+    """
+    assert all(get_provider(model) == "openai" for model in models), "only the OpenAI models have a batch API"
+    os.makedirs(output_dir, exist_ok=True)
+    for model in models:
+        with open(os.path.join(output_dir, f"{model}.jsonl"), "w", encoding="utf-8") as f:
+            for dataset_name in dataset_names:
+                for questions_by_area in get_dataset(dataset_name).values():
+                    for question in questions_by_area.values():
+                        request = dict(
+                            custom_id=get_batch_custom_id(model, dataset_name, question["id"]),
+                            method="POST",
+                            url="/v1/chat/completions",
+                            body=dict(
+                                model=model,
+                                messages=[dict(role="user", content=question["prompt"])],
+                                **OPENAI_GENERATION_PARAMS,
+                            ),
                         )
-                    )
-                    # break  # only to test, remove after testing
-            with open(
-                os.path.join("..", "reports", f"{model}_{DATASET_TO_FILENAME[dataset_name]}"), "w", encoding="utf-8"
-            ) as f:
-                json.dump(report, f, indent=4, ensure_ascii=False)
+                        f.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+
+def ingest_batch(batch_output_paths: list[str]):
+    """Builds the reports from the output files of the batch requests written by export_batch
+
+    The answers go through the same checkpoint as evaluate, so if some requests failed, the report is not written
+    and `evaluate --resume` answers only the missing questions.
+
+    Args:
+        batch_output_paths (list[str]): List of batch output files (jsonl).
+    """
+    if isinstance(batch_output_paths, str):
+        batch_output_paths = [batch_output_paths]
+
+    answers = {}  # by (model, dataset_name), then by question id
+    failed = 0
+    for batch_output_path in batch_output_paths:
+        with open(batch_output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                result = json.loads(line)
+                model, dataset_name, question_id = parse_batch_custom_id(result["custom_id"])
+                assert get_provider(model) == "openai", f"{model} is not an OpenAI model, see export_batch"
+                response = result.get("response")
+                if result.get("error") is not None or response is None or response["status_code"] != 200:
+                    failed += 1
+                    continue
+                content = response["body"]["choices"][0]["message"]["content"]
+                answers.setdefault((model, dataset_name), {})[question_id] = content.strip()
+
+    for (model, dataset_name), answers_by_id in answers.items():
+        dataset = get_dataset(dataset_name)
+        report_path = get_report_path(model, dataset_name)
+        checkpoint_path = get_checkpoint_path(report_path)
+
+        done = load_checkpoint(checkpoint_path)
+        missing = 0
+        with open(checkpoint_path, "w", encoding="utf-8") as checkpoint_file:
+            for questions_by_area in dataset.values():
+                for question in questions_by_area.values():
+                    if question["id"] in answers_by_id:
+                        done[question["id"]] = get_report_item(question, answers_by_id[question["id"]])
+                    elif question["id"] not in done:
+                        missing += 1
+            for item in done.values():
+                write_checkpoint_item(checkpoint_file, item)
+
+        if missing > 0:
+            print(
+                f"{model} on {dataset_name}: {missing} answers missing, "
+                f"run evaluate with --resume to answer them and write {report_path}"
+            )
+            continue
+
+        report = build_report(dataset, checkpoint_path)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+        os.remove(checkpoint_path)
+
+    if failed > 0:
+        print(f"{failed} requests failed in the batch")
+
+
+def rescore_report(report_path) -> tuple[list[dict], list[dict], int] | None:
+    """re-extracts the pred of each item of a report, returns the rescored report, the changed items and how many
+    have no letter"""
+    with open(report_path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    if not isinstance(report, list) or not all(isinstance(item, dict) and "response" in item for item in report):
+        return None  # not an evaluation report
+
+    changes = []
+    failed = 0
+    for item in report:
+        if "samples" in item:
+            # self-consistency, the vote of the samples
+            item["sample_preds"] = [extract_answer(sample) or sample for sample in item["samples"]]
+            pred, item["agreement"] = get_vote(item["sample_preds"])
+            item["response"] = pred
+            failed += pred == ""
+        else:
+            pred = extract_answer(item["response"])
+            if pred is None:
+                failed += 1
+                pred = item["response"]
+        if pred != item["pred"]:
+            changes.append(dict(id=item["id"], old_pred=item["pred"], new_pred=pred, gold=item["gold"]))
+            item["pred"] = pred
+    return report, changes, failed
+
+
+def rescore(report_paths: list[str] = None, write: bool = False, max_workers: int = None):
+    """Extracts again the answers of existing reports from their stored responses, without calling the LLMs
+
+    Args:
+        report_paths (list[str]): List of reports (glob patterns are accepted). Defaults to every report in "../reports".
+        write (bool): Overwrites the reports with the new predictions. Defaults to False (only shows the changes).
+        max_workers (int): Number of processes. Defaults to the number of CPUs.
+    """
+    if report_paths is None:
+        report_paths = [os.path.join("..", "reports", "*.json")]
+    elif isinstance(report_paths, str):
+        report_paths = [report_paths]
+    report_paths = sorted({path for pattern in report_paths for path in glob.glob(pattern)})
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(rescore_report, report_paths, chunksize=max(1, len(report_paths) // 64))
+        for report_path, result in zip(report_paths, results):
+            if result is None:
+                continue
+            report, changes, failed = result
+            new_correct = sum(item["pred"] == item["gold"] for item in report)
+            old_correct = new_correct + sum((c["old_pred"] == c["gold"]) - (c["new_pred"] == c["gold"]) for c in changes)
+            print(
+                f"{report_path}: {len(changes)} predictions changed, {failed} without answer, "
+                f"accuracy {old_correct}/{len(report)} -> {new_correct}/{len(report)}"
+            )
+            for change in changes:
+                print(f"\t{change['id']}: {change['old_pred']!r} -> {change['new_pred']!r} (gold {change['gold']})")
+            if write and len(changes) > 0:
+                with open(report_path, "w", encoding="utf-8") as f:
+                    json.dump(report, f, indent=4, ensure_ascii=False)
 
 
 def build_results_table(
     output_filename: str = None,
     models: list[str] = ["gpt-3.5-turbo-0613", "gpt-4-0613"],
     dataset_names: list[str] = ["Zero-shot", "Few-shot", "Few-shot with Chain-of-Thought"],
+    n_bootstrap: int = 0,
+    confidence: float = 0.95,
 ):
     """Build the results table from the evaluation reports
 
     Args:
         models (list[str]): List of LLMs. Defaults to "['gpt-3.5-turbo-0613', 'gpt-4-0613']".
         dataset_names (list[str]): List of dataset names. Defaults to "['Zero-shot', 'Few-shot', 'Few-shot with Chain-of-Thought']".
+        n_bootstrap (int): Number of bootstrap resamples of the confidence intervals, e.g., 10000. Defaults to 0 (no intervals).
+        confidence (float): Confidence level of the intervals. Defaults to 0.95.
     """
     # getting acc
-    table = {}
-    for model in models:
-        table[model] = {}
-        for dataset_name in dataset_names:
-            table[model][dataset_name] = {
-                "is_correct": {v: 0 for v in list(AREA_MAP.values()) + ["Total"]},
-                "count": {v: 0 for v in list(AREA_MAP.values()) + ["Total"]},
-            }
-
-            with open(
-                os.path.join("..", "reports", f"{model}_{DATASET_TO_FILENAME[dataset_name]}"), "r", encoding="utf-8"
-            ) as f:
-                report = json.load(f)
-
-            for item in report:
-                is_correct = item["pred"] == item["gold"]
-                table[model][dataset_name]["is_correct"][AREA_MAP[item["area"]]] += is_correct
-                table[model][dataset_name]["is_correct"]["Total"] += is_correct
-                table[model][dataset_name]["count"][AREA_MAP[item["area"]]] += 1
-                table[model][dataset_name]["count"]["Total"] += 1
+    report_paths = [[get_report_path(model, dataset_name) for dataset_name in dataset_names] for model in models]
+    is_correct_by_area, count_by_area = load_report_accuracies(report_paths)
+    if n_bootstrap > 0:
+        # the resamples are shared by the reports, so they must have the same questions
+        correct, areas = load_correctness_matrix(report_paths)
+        intervals = get_bootstrap_intervals(correct, areas, n_bootstrap=n_bootstrap, confidence=confidence)
 
     # formatting as html table
     html_table = '<table border="1px">\n'
@@ -184,15 +912,19 @@ def build_results_table(
             html_table += f"\t\t<th>{DATASET_TO_TITLE[dataset_name]}</th>\n"
     html_table += "\t</tr>\n"
 
-    for area in list(AREA_MAP.values()) + ["Total"]:
+    for area_index, area in enumerate([AREA_MAP[area] for area in AREAS] + ["Total"]):
         html_table += "\t<tr>\n"
         html_table += f"\t\t<td>{area}</td>\n"
-        for model in models:
-            for dataset_name in dataset_names:
-                is_correct = table[model][dataset_name]["is_correct"][area]
-                count = table[model][dataset_name]["count"][area]
+        for model_index in range(len(models)):
+            for dataset_index in range(len(dataset_names)):
+                is_correct = is_correct_by_area[model_index, dataset_index, area_index]
+                count = count_by_area[model_index, dataset_index, area_index]
                 acc = is_correct / count
-                html_table += f"\t\t<td>{is_correct}/{count} ({acc:.2%})</td>\n"
+                if n_bootstrap > 0:
+                    lower, upper = intervals[model_index, dataset_index, area_index]
+                    html_table += f"\t\t<td>{is_correct}/{count} ({acc:.2%}) [{lower:.2%}, {upper:.2%}]</td>\n"
+                else:
+                    html_table += f"\t\t<td>{is_correct}/{count} ({acc:.2%})</td>\n"
         html_table += "\t</tr>\n"
 
     html_table += "</table>"
@@ -208,6 +940,10 @@ if __name__ == "__main__":
         {
             "evaluate": evaluate,
             "build_results_table": build_results_table,
+            "export_batch": export_batch,
+            "ingest_batch": ingest_batch,
+            "rescore": rescore,
+            "wake_endpoints": wake_endpoints,
         }
     )
     # models = ["gpt-3.5-turbo-0613", "gpt-4-0613", "Falcon-7B", "LLaMA-2-7B", "MariTalk"]
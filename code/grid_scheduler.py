@@ -0,0 +1,103 @@
+import queue
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from typing import Callable
+from tqdm import tqdm
+
+
+@dataclass
+class CellProgress:
+    """sent to the workers, so they can report their progress to the main process"""
+
+    progress_queue: queue.Queue
+    cell_index: int
+
+    def set_total(self, total: int) -> None:
+        self.progress_queue.put((self.cell_index, "total", total))
+
+    def update(self, n: int = 1) -> None:
+        self.progress_queue.put((self.cell_index, "update", n))
+
+
+def run_grid(
+    cells: list[tuple],
+    worker: Callable,
+    get_provider: Callable[[tuple], str],
+    max_workers_per_provider: dict[str, int],
+    default_max_workers: int = 1,
+    get_description: Callable[[tuple], str] = lambda cell: " ".join(str(arg) for arg in cell),
+) -> None:
+    """Runs worker(*cell, progress) for each cell in its own process.
+
+    At most max_workers_per_provider[provider] cells of the same provider run at the same time, so each provider
+    is kept busy up to its own rate limit, and the wall-clock time is the one of the slowest provider.
+    A progress bar is shown for each cell, in place of the nested bars of the sequential evaluation.
+
+    Args:
+        cells (list[tuple]): the arguments of each call, e.g., (model, dataset_name).
+        worker (Callable): top-level (picklable) function, called with the cell arguments and a CellProgress.
+        get_provider (Callable[[tuple], str]): returns the provider of a cell.
+        max_workers_per_provider (dict[str, int]): maximum number of processes used by each provider.
+        default_max_workers (int): used for providers not in max_workers_per_provider. Defaults to 1.
+        get_description (Callable[[tuple], str]): label of the progress bar of a cell.
+    """
+    pending: dict[str, deque] = {}
+    for cell_index, cell in enumerate(cells):
+        pending.setdefault(get_provider(cell), deque()).append(cell_index)
+    limits = {provider: max_workers_per_provider.get(provider, default_max_workers) for provider in pending}
+    assert all(limit >= 1 for limit in limits.values()), "each provider needs at least one worker"
+    in_flight = {provider: 0 for provider in pending}
+
+    total_bar = tqdm(total=len(cells), desc="Evaluating all", position=0)
+    cell_bars = [
+        tqdm(total=None, desc=get_description(cell), position=cell_index + 1, leave=False)
+        for cell_index, cell in enumerate(cells)
+    ]
+
+    errors = []
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=sum(limits.values())) as executor:
+        progress_queue = manager.Queue()
+        running = {}
+
+        def submit_ready():
+            for provider, cell_indexes in pending.items():
+                while len(cell_indexes) > 0 and in_flight[provider] < limits[provider]:
+                    cell_index = cell_indexes.popleft()
+                    future = executor.submit(worker, *cells[cell_index], CellProgress(progress_queue, cell_index))
+                    running[future] = (provider, cell_index)
+                    in_flight[provider] += 1
+
+        def drain_progress_queue():
+            while True:
+                try:
+                    cell_index, kind, n = progress_queue.get_nowait()
+                except queue.Empty:
+                    return
+                if kind == "total":
+                    cell_bars[cell_index].reset(total=n)
+                else:
+                    cell_bars[cell_index].update(n)
+
+        submit_ready()
+        while len(running) > 0:
+            done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+            drain_progress_queue()
+            for future in done:
+                provider, cell_index = running.pop(future)
+                in_flight[provider] -= 1
+                try:
+                    future.result()
+                except Exception as e:
+                    # the other cells keep running, the reports already written are kept
+                    errors.append(e)
+                    tqdm.write(f"{cells[cell_index]} failed: {e!r}")
+                cell_bars[cell_index].close()
+                total_bar.update()
+            submit_ready()
+        drain_progress_queue()
+
+    total_bar.close()
+    if len(errors) > 0:
+        raise errors[0]
@@ -1,6 +1,11 @@
 import os
 import json
 import uuid
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
 from jinja2 import Environment, FileSystemLoader
 from chat_completion_wrapper import ChatMessage
 from dataclasses import dataclass, field
@@ -65,6 +70,11 @@ class LogMessage:
         # return f'<pre style="color:blue">{content}</pre>'
         return content
 
+    def to_dict(self) -> dict:
+        return dict(
+            type="LogMessage", content=self.content, timestamp=self.timestamp.isoformat(), observation=self.observation
+        )
+
 
 @dataclass  # slots?
 class LogChatMessage:
@@ -83,17 +93,93 @@ class LogChatMessage:
         # return f'<span style="color:{role_color};font-weight:bold;">{self.chat_message.role.upper()}</span>> <pre style="color:{content_color}">{content}</pre>'
         return f"<b>{self.chat_message.role.upper()}</b>> {content}"
 
+    def to_dict(self) -> dict:
+        return dict(
+            type="LogChatMessage",
+            role=self.chat_message.role,
+            content=self.chat_message.content,
+            timestamp=self.timestamp.isoformat(),
+            observation=self.observation,
+        )
+
+
+def log_message_from_dict(record: dict) -> LogMessage | LogChatMessage:
+    timestamp = datetime.fromisoformat(record["timestamp"])
+    if record["type"] == "LogChatMessage":
+        return LogChatMessage(
+            chat_message=ChatMessage(role=record["role"], content=record["content"]),
+            timestamp=timestamp,
+            observation=record["observation"],
+        )
+    return LogMessage(content=record["content"], timestamp=timestamp, observation=record["observation"])
+
+
+# the log session of the messages logged in this context, e.g., the id of a streamlit session
+_log_session: contextvars.ContextVar[str] = contextvars.ContextVar("log_session", default="")
+
+
+@contextmanager
+def log_session(session_id: str):
+    """the messages logged inside the block (including the asyncio tasks started in it) go to the log file of the
+    session, and logger.save() only ends this session, e.g., with log_session(st.session_state["log_session_id"]): ..."""
+    token = _log_session.set(session_id)
+    try:
+        yield
+    finally:
+        _log_session.reset(token)
+
 
 class _Logger:
+    """Appends the log messages to a jsonl file per session, written by a background thread.
+
+    Only the messages not yet written are kept in memory (up to max_queue_size, then logging waits for the writer),
+    and the HTML is rendered on demand from the jsonl file with render_html. The messages logged outside of
+    log_session belong to the default session of the process.
+    """
+
     _counter = 0
 
-    def __init__(self, print_stdout: bool = False) -> None:
+    def __init__(self, print_stdout: bool = False, max_queue_size: int = 1000) -> None:
         _Logger._counter += 1
         assert _Logger._counter == 1, "Logger should not be instantiated out of this file!"
         env = Environment(loader=FileSystemLoader(os.path.join(Path(__file__).parent.parent.resolve(), "log-templates")))
         self.template = env.get_template("template.jinja2")
         self.print_stdout = print_stdout
-        self.log_messages: list[LogMessage | LogChatMessage] = []
+        self.log_dir = os.path.join(Path(__file__).parent.parent.resolve(), "log")
+        self.lock = threading.Lock()
+        self.log_filepaths: dict[str, str] = {}  # by log session, created on the first message
+        self.queue: queue.Queue[tuple[str, str]] = queue.Queue(maxsize=max_queue_size)
+        self.writer = threading.Thread(target=self._write_forever, daemon=True)
+        self.writer.start()
+        atexit.register(self.flush)
+
+    def _new_log_filepath(self) -> str:
+        return os.path.join(self.log_dir, f"{str(uuid.uuid4())}.jsonl")
+
+    @property
+    def log_filepath(self) -> str:
+        """log file of the current session"""
+        with self.lock:
+            return self.log_filepaths.setdefault(_log_session.get(), self._new_log_filepath())
+
+    def _write_forever(self) -> None:
+        file, file_path = None, None
+        while True:
+            log_filepath, line = self.queue.get()
+            try:
+                if log_filepath != file_path:
+                    if file is not None:
+                        file.close()
+                    file, file_path = open(log_filepath, "a", encoding="utf-8"), log_filepath
+                file.write(line)
+                if self.queue.empty():
+                    file.flush()
+            except OSError as e:
+                # the thread must keep running, otherwise flush() would wait forever
+                print(f"WARNING: could not write the log to {log_filepath}: {e!r}")
+                file, file_path = None, None
+            finally:
+                self.queue.task_done()
 
     def __call__(self, content: str | ChatMessage, observation: str | None = None) -> None:
         if type(content) is ChatMessage:
@@ -104,20 +190,43 @@ class _Logger:
         if self.print_stdout:
             print(log_message.to_console())
         # self.logger.info(log_message.to_html())
-        self.log_messages.append(log_message)
+        line = json.dumps(log_message.to_dict(), ensure_ascii=False, default=str) + "\n"
+        self.queue.put((self.log_filepath, line))
+
+    def flush(self) -> None:
+        """waits until every message logged so far is on disk"""
+        self.queue.join()
 
     def save(self) -> str:
-        log_filepath = os.path.join(Path(__file__).parent.parent.resolve(), "log", f"{str(uuid.uuid4())}.html")
-        output = self.template.render(log_messages=self.log_messages)
-        # Write the rendered output to an HTML file
-        with open(log_filepath, "w", encoding="utf-8") as file:
-            file.write(output)
-        self.log_messages = []
+        """ends the current session, returning its log file, and starts a new one"""
+        with self.lock:
+            log_filepath = self.log_filepaths.pop(_log_session.get(), None) or self._new_log_filepath()
+        self.flush()
         return log_filepath
 
+    def render_html(self, log_filepath: str) -> str:
+        log_messages = []
+        if os.path.exists(log_filepath):  # nothing was logged in the session
+            with open(log_filepath, "r", encoding="utf-8") as file:
+                log_messages = [log_message_from_dict(json.loads(line)) for line in file]
+        return self.template.render(log_messages=log_messages)
+
+    def save_html(self, log_filepath: str) -> str:
+        html_filepath = os.path.splitext(log_filepath)[0] + ".html"
+        with open(html_filepath, "w", encoding="utf-8") as file:
+            file.write(self.render_html(log_filepath))
+        return html_filepath
+
 
 # singleton like! use this, do not instanciate another Logger
 logger = _Logger(print_stdout=False)
 
 
+if __name__ == "__main__":
+    import fire
+
+    # e.g., python logger.py ../log/xxxx.jsonl
+    fire.Fire(logger.save_html)
+
+
 # colocar tipo do dado! do content ?
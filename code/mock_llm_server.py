@@ -0,0 +1,440 @@
+import os
+import json
+import math
+import time
+import random
+import hashlib
+import tempfile
+import threading
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI API, Hugging Face TGI endpoints and the endpoints API, to measure the harness
+# (concurrency, cache, rate limits, retries) without calling the real LLMs. Everything is seeded: the same request
+# gets the same answer, latency and errors on every run.
+
+
+@dataclass
+class MockLLMConfig:
+    """Args:
+    latency_median (float): median latency of a request, in seconds. Defaults to 0.2.
+    latency_sigma (float): sigma of the log-normal latency distribution (0 for a constant latency). Defaults to 0.5.
+    error_rate_429 (float): fraction of the requests answered with 429 (rate limit). Defaults to 0.
+    error_rate_5xx (float): fraction of the requests answered with 500 or 503. Defaults to 0.
+    cold_start (float): seconds a TGI endpoint takes to start, it starts scaled to zero if > 0. Defaults to 0.
+    seed (int): seed of the answers, latencies and errors. Defaults to 0.
+    """
+
+    latency_median: float = 0.2
+    latency_sigma: float = 0.5
+    error_rate_429: float = 0.0
+    error_rate_5xx: float = 0.0
+    cold_start: float = 0.0
+    seed: int = 0
+
+
+@dataclass
+class RequestRecord:
+    api: str  # openai or tgi
+    status: int
+    latency: float
+    attempt: int  # 0 for the first time the same request is received
+    retry: bool = False  # the previous attempt of the same request got an error, otherwise a duplicate (e.g., hedging)
+
+
+def get_mock_letter(prompt: str, seed: int = 0) -> str:
+    digest = hashlib.sha256(f"{seed}:{prompt}".encode("utf-8")).digest()
+    return "ABCDE"[digest[0] % 5]
+
+
+def get_mock_answer(prompt: str, seed: int = 0, sample: int | None = None) -> str:
+    """a fixed answer letter for each prompt, in the format of the expected answers. A sampled answer (temperature
+    above 0) keeps the letter 60% of the time, the same for the same sample index"""
+    letter = get_mock_letter(prompt, seed)
+    if sample is not None:
+        rng = random.Random(f"{seed}:{prompt}:{sample}")
+        letter = letter if rng.random() < 0.6 else rng.choice("ABCDE")
+    if "Explicação:" in prompt[-100:]:
+        return f"As alternativas foram analisadas e a alternativa {letter}. é a CORRETA. Resposta: {letter}."
+    return f"{letter}. é a alternativa correta."
+
+
+def get_mock_logprobs(prompt: str, seed: int = 0) -> dict[str, float]:
+    """log probabilities of the answer letters as the first token, the letter of get_mock_answer is the most likely.
+    The rest of the probability goes to other tokens"""
+    rng = random.Random(f"{seed}:{prompt}")
+    logits = {letter: rng.gauss(0, 1) for letter in "ABCDE"}
+    logits[get_mock_letter(prompt, seed)] = max(logits.values()) + 1 + rng.random()
+    log_total = math.log(sum(math.exp(logit) for logit in logits.values()) + 1)
+    return {letter: logit - log_total for letter, logit in logits.items()}
+
+
+def split_tokens(text: str) -> list[str]:
+    """pseudo tokens (words with their leading space) for the streamed answers"""
+    words = text.split(" ")
+    return [words[0]] + [" " + word for word in words[1:]]
+
+
+class _MockLLMRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real APIs
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    @property
+    def mock(self) -> "MockLLMServer":
+        return self.server.mock
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length > 0 else {}
+
+    def _send_json(self, status: int, body, headers: dict | None = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, events: list[str], delay: float) -> None:
+        """server-sent events, spread over delay seconds. The connection is closed at the end"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for event in events:
+                time.sleep(delay / len(events))
+                self.wfile.write(f"data:{event}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped reading (early stop)
+
+    def _send_error(self, api: str, status: int) -> None:
+        if api == "openai":
+            error_type = "requests" if status == 429 else "server_error"
+            body = dict(error=dict(message=f"Mock error {status}", type=error_type, param=None, code=None))
+        else:
+            body = dict(error=f"Mock error {status}", error_type="overloaded" if status == 429 else "generation")
+        self._send_json(status, body, headers={"Retry-After": "1"} if status == 429 else None)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, dict(object="list", data=[dict(id="mock", object="model", owned_by="mock")]))
+        elif self.path.startswith("/v2/endpoint/"):
+            name = self.path.rstrip("/").split("/")[-1]
+            self._send_json(200, dict(name=name, status=dict(state=self.mock.get_endpoint_state(name))))
+        else:
+            self._send_json(404, dict(error="Not found"))
+
+    def do_POST(self) -> None:
+        body = self._read_json()
+        if self.path.rstrip("/") == "/v1/chat/completions":
+            self._openai_chat_completion(body)
+        elif self.path.startswith("/tgi/"):
+            self._tgi_generate(self.path.rstrip("/").split("/")[-1], body)
+        else:
+            self._send_json(404, dict(error="Not found"))
+
+    def _openai_chat_completion(self, body: dict) -> None:
+        prompt = body["messages"][-1]["content"]
+        status, latency, attempt, retry = self.mock.draw(body)
+        if status != 200:
+            time.sleep(latency / 10)  # the errors are fast
+            self.mock.record("openai", status, latency / 10, attempt, retry)
+            return self._send_error("openai", status)
+
+        # the sampled answers (temperature above 0) differ, and they are cut after max_tokens pseudo tokens
+        n = body.get("n", 1)
+        samples = [attempt * n + i if body.get("temperature", 1) > 0 else None for i in range(n)]
+        answers_tokens = [split_tokens(get_mock_answer(prompt, self.mock.config.seed, sample)) for sample in samples]
+        max_tokens = body.get("max_tokens") or max(len(answer_tokens) for answer_tokens in answers_tokens)
+        finish_reasons = ["length" if max_tokens < len(answer_tokens) else "stop" for answer_tokens in answers_tokens]
+        answers_tokens = [answer_tokens[:max_tokens] for answer_tokens in answers_tokens]
+        answer_tokens, finish_reason = answers_tokens[0], finish_reasons[0]
+        chunk = dict(id="chatcmpl-mock", created=int(time.time()), model=body.get("model", "mock"))
+        if body.get("stream"):
+            deltas = [dict(role="assistant")] + [dict(content=token) for token in answer_tokens] + [{}]
+            events = [
+                json.dumps(
+                    dict(
+                        chunk,
+                        object="chat.completion.chunk",
+                        choices=[dict(index=0, delta=delta, finish_reason=finish_reason if delta == {} else None)],
+                    ),
+                    ensure_ascii=False,
+                )
+                for delta in deltas
+            ]
+            events.append("[DONE]")
+            self._send_events(events, latency)
+        elif body.get("logprobs"):
+            # a single token with the top tokens, as requested by score_choices
+            time.sleep(latency)
+            logprobs = sorted(get_mock_logprobs(prompt, self.mock.config.seed).items(), key=lambda item: -item[1])
+            top_logprobs = [dict(token=token, logprob=logprob, bytes=None) for token, logprob in logprobs]
+            content = [dict(top_logprobs[0], top_logprobs=top_logprobs[: body.get("top_logprobs", 0)])]
+            choices = [
+                dict(
+                    index=0,
+                    message=dict(role="assistant", content=logprobs[0][0]),
+                    logprobs=dict(content=content),
+                    finish_reason="length",
+                )
+            ]
+            prompt_tokens = sum(len(msg["content"]) for msg in body["messages"]) // 4
+            usage = dict(prompt_tokens=prompt_tokens, completion_tokens=1, total_tokens=prompt_tokens + 1)
+            self._send_json(200, dict(chunk, object="chat.completion", choices=choices, usage=usage))
+        else:
+            time.sleep(latency)
+            choices = [
+                dict(index=i, message=dict(role="assistant", content="".join(tokens)), finish_reason=finish_reasons[i])
+                for i, tokens in enumerate(answers_tokens)
+            ]
+            prompt_tokens = sum(len(msg["content"]) for msg in body["messages"]) // 4
+            completion_tokens = sum(len(tokens) for tokens in answers_tokens)
+            usage = dict(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            )
+            self._send_json(200, dict(chunk, object="chat.completion", choices=choices, usage=usage))
+        self.mock.record("openai", 200, latency, attempt, retry)
+
+    def _tgi_generate(self, name: str, body: dict) -> None:
+        if self.mock.get_endpoint_state(name, wake=True) != "running":
+            self.mock.record("tgi", 503, 0.0, 0)
+            return self._send_json(503, dict(error="Service Unavailable", error_type="loading"))
+
+        status, latency, attempt, retry = self.mock.draw(body)
+        if status != 200:
+            time.sleep(latency / 10)
+            self.mock.record("tgi", status, latency / 10, attempt, retry)
+            return self._send_error("tgi", status)
+
+        # the HF wrappers send a temperature of 0.001 for 0
+        sampled = body.get("parameters", {}).get("temperature", 1) > 0.01
+        answer = get_mock_answer(body["inputs"], self.mock.config.seed, attempt if sampled else None)
+        tokens = [dict(id=i, text=text, logprob=-0.1, special=False) for i, text in enumerate(split_tokens(answer))]
+        tokens.append(dict(id=len(tokens), text="</s>", logprob=-0.1, special=True))
+        max_new_tokens = body.get("parameters", {}).get("max_new_tokens") or len(tokens)
+        finish_reason = "length" if max_new_tokens < len(tokens) else "eos_token"
+        tokens = tokens[:max_new_tokens]
+        generated_text = "".join(token["text"] for token in tokens if not token["special"])
+        details = dict(finish_reason=finish_reason, generated_tokens=len(tokens), seed=None)
+        if body.get("stream"):
+            events = [
+                json.dumps(
+                    dict(
+                        token=token,
+                        generated_text=generated_text if i == len(tokens) - 1 else None,
+                        details=details if i == len(tokens) - 1 else None,
+                    ),
+                    ensure_ascii=False,
+                )
+                for i, token in enumerate(tokens)
+            ]
+            self._send_events(events, latency)
+        elif body.get("parameters", {}).get("decoder_input_details"):
+            # the prompt ends with an answer letter appended by score_choices, its log probability is in the prefill
+            time.sleep(latency)
+            inputs, letter = body["inputs"][:-1], body["inputs"][-1]
+            logprob = get_mock_logprobs(inputs.rstrip(), self.mock.config.seed).get(letter, -20.0)
+            prefill = [dict(id=i, text=text, logprob=-1.0) for i, text in enumerate(split_tokens(inputs))]
+            prefill[0]["logprob"] = None
+            prefill.append(dict(id=len(prefill), text=letter, logprob=logprob))
+            details = dict(details, finish_reason="length", generated_tokens=1, prefill=prefill, tokens=tokens[:1])
+            self._send_json(200, [dict(generated_text=tokens[0]["text"], details=details)])
+        else:
+            time.sleep(latency)
+            details = dict(details, prefill=[], tokens=tokens)
+            self._send_json(200, [dict(generated_text=generated_text, details=details)])
+        self.mock.record("tgi", 200, latency, attempt, retry)
+
+
+class MockLLMServer:
+    """Serves the OpenAI chat completions (/v1), TGI endpoints (/tgi/<name>) and the endpoints API (/v2/endpoint).
+
+    Args:
+        config (MockLLMConfig): latencies, errors and cold start.
+        host (str): Defaults to "127.0.0.1".
+        port (int): Defaults to 0 (any free port).
+    """
+
+    def __init__(self, config: MockLLMConfig | None = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.config = MockLLMConfig() if config is None else config
+        self.httpd = ThreadingHTTPServer((host, port), _MockLLMRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.lock = threading.Lock()
+        self.records: list[RequestRecord] = []
+        self.attempts: dict[str, int] = {}
+        self.failed: dict[str, bool] = {}  # whether the last attempt of each request got an error
+        self.endpoint_woken_at: dict[str, float] = {}
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockLLMServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_endpoint_state(self, name: str, wake: bool = False) -> str:
+        if self.config.cold_start <= 0:
+            return "running"
+        with self.lock:
+            woken_at = self.endpoint_woken_at.get(name)
+            if woken_at is None:
+                if not wake:
+                    return "scaledToZero"
+                woken_at = self.endpoint_woken_at[name] = time.monotonic()
+        return "running" if time.monotonic() - woken_at >= self.config.cold_start else "initializing"
+
+    def draw(self, body: dict) -> tuple[int, float, int, bool]:
+        """status and latency of a request, the same for the same request and attempt, the attempt and whether it is
+        the retry of an error"""
+        key = hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        rng = random.Random(f"{self.config.seed}:{key}:{attempt}")
+        latency = self.config.latency_median * math.exp(self.config.latency_sigma * rng.gauss(0, 1))
+        error = rng.random()
+        if error < self.config.error_rate_429:
+            status = 429
+        elif error < self.config.error_rate_429 + self.config.error_rate_5xx:
+            status = rng.choice([500, 503])
+        else:
+            status = 200
+        with self.lock:
+            retry = self.failed.get(key, False)
+            self.failed[key] = status != 200
+        return status, latency, attempt, retry
+
+    def record(self, api: str, status: int, latency: float, attempt: int, retry: bool = False) -> None:
+        with self.lock:
+            self.records.append(RequestRecord(api=api, status=status, latency=latency, attempt=attempt, retry=retry))
+
+
+def serve(port: int = 8000, **config):
+    """Runs the mock server until interrupted
+
+    Args:
+        port (int): Defaults to 8000.
+        config: see MockLLMConfig, e.g., --latency_median 0.5 --error_rate_429 0.05
+    """
+    server = MockLLMServer(MockLLMConfig(**config), port=port).start()
+    print(f"OpenAI: {server.url}/v1, TGI: {server.url}/tgi/<name>, endpoints API: {server.url}/v2/endpoint")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def benchmark(
+    models: list[str] = ["gpt-3.5-turbo-0613"],
+    dataset_names: list[str] = ["Zero-shot"],
+    output_path: str | None = None,
+    latency_median: float = 0.2,
+    latency_sigma: float = 0.5,
+    error_rate_429: float = 0.0,
+    error_rate_5xx: float = 0.0,
+    cold_start: float = 0.0,
+    seed: int = 0,
+    **evaluate_kwargs,
+):
+    """Runs evaluate against the mock server and reports the throughput, the tail latency and the retries
+
+    Args:
+        models (list[str]): OpenAI or Hugging Face models (MariTalk can't be mocked). Defaults to "['gpt-3.5-turbo-0613']".
+        dataset_names (list[str]): List of dataset names. Defaults to "['Zero-shot']".
+        output_path (str | None): json file to write the results to. Defaults to None (only printed).
+        latency_median, latency_sigma, error_rate_429, error_rate_5xx, cold_start, seed: see MockLLMConfig.
+        evaluate_kwargs: passed to evaluate, e.g., --concurrency 8 --grid --cache_path ... --early_stop. The models are
+            not rate limited unless --rate_limits is given, so the results measure the evaluation, not the limits.
+    """
+    import openai
+    from evaluator import evaluate, get_dataset, get_provider
+    from chat_completion_wrapper import get_metrics_recorder
+    from chat_completion_wrapper.metrics import get_quantile
+
+    if isinstance(models, str):
+        models = [models]
+    if isinstance(dataset_names, str):
+        dataset_names = [dataset_names]
+    assert all(get_provider(model) in ["openai", "huggingface"] for model in models), "only OpenAI and HF models"
+
+    config = MockLLMConfig(latency_median, latency_sigma, error_rate_429, error_rate_5xx, cold_start, seed)
+    server = MockLLMServer(config).start()
+
+    # the wrappers are pointed to the mock server (the processes of the grid inherit the environment)
+    os.environ["OPENAI_API_KEY"] = openai.api_key = "mock"
+    os.environ["OPENAI_API_BASE"] = openai.api_base = f"{server.url}/v1"
+    os.environ["huggingface_token"] = "mock"
+    os.environ["huggingface_namespace"] = "mock"
+    os.environ["huggingface_endpoints_api_url"] = f"{server.url}/v2/endpoint"
+    for model in models:
+        os.environ[f"huggingface_{model.replace('-', '')}_url"] = f"{server.url}/tgi/{model}"
+        os.environ[f"huggingface_{model.replace('-', '')}_name"] = model
+
+    n_questions = len(models) * sum(
+        len(questions_by_area)
+        for dataset_name in dataset_names
+        for questions_by_area in get_dataset(dataset_name).values()
+    )
+    metrics_snapshot = get_metrics_recorder().snapshot()
+    try:
+        with tempfile.TemporaryDirectory() as reports_dir:
+            started_at = time.perf_counter()
+            evaluate(models=models, dataset_names=dataset_names, reports_dir=reports_dir, **evaluate_kwargs)
+            elapsed = time.perf_counter() - started_at
+    finally:
+        server.stop()
+
+    latencies = [record.latency for record in server.records if record.status == 200]
+    errors = {}
+    for record in server.records:
+        if record.status != 200:
+            errors[record.status] = errors.get(record.status, 0) + 1
+    results = dict(
+        questions=n_questions,
+        elapsed=elapsed,
+        questions_per_second=n_questions / elapsed,
+        requests=len(server.records),
+        errors=errors,
+        retried_requests=sum(record.retry for record in server.records),
+        # sent again while the first one was in flight or had succeeded: hedged requests, and the identical requests
+        # of the self-consistency samples of the Hugging Face models
+        duplicate_requests=sum(record.attempt > 0 and not record.retry for record in server.records),
+        latency_p50=get_quantile(latencies, 0.50),
+        latency_p90=get_quantile(latencies, 0.90),
+        latency_p99=get_quantile(latencies, 0.99),
+        latency_max=max(latencies, default=None),
+        # as measured by the wrappers (not with grid)
+        client_metrics=get_metrics_recorder().summary(since=metrics_snapshot),
+        config=asdict(config),
+        evaluate_kwargs=evaluate_kwargs,
+    )
+
+    print(json.dumps(results, indent=4))
+    if output_path is not None:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire({"serve": serve, "benchmark": benchmark})
@@ -0,0 +1,182 @@
+import os
+import json
+import numpy as np
+from statistics import NormalDist
+
+# the order of the areas in the arrays, the last column of the aggregates is the total
+AREAS = ["languages", "human-sciences", "natural-sciences", "mathematics"]
+
+
+def get_cache_path(report_path) -> str:
+    """the arrays of reports/x.json are cached in reports/.cache/x.npz"""
+    report_dir, report_filename = os.path.split(report_path)
+    return os.path.join(report_dir, ".cache", os.path.splitext(report_filename)[0] + ".npz")
+
+
+def load_report_arrays(report_path) -> dict[str, np.ndarray]:
+    """Loads a report as arrays: the question ids, the area index (see AREAS) and whether the answer is correct.
+
+    The arrays are cached next to the report and rebuilt when the report changes (size or modification time).
+    """
+    stat = os.stat(report_path)
+    signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    cache_path = get_cache_path(report_path)
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cached:
+                if np.array_equal(cached["signature"], signature):
+                    return dict(ids=cached["ids"], areas=cached["areas"], correct=cached["correct"])
+        except (OSError, ValueError, KeyError):
+            pass  # corrupted cache, rebuilt below
+
+    with open(report_path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    arrays = dict(
+        ids=np.array([item["id"] for item in report], dtype=str),
+        areas=np.array([AREAS.index(item["area"]) for item in report], dtype=np.int8),
+        correct=np.array([item["pred"] == item["gold"] for item in report], dtype=bool),
+    )
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # np.savez adds the extension, so the temporary file already ends with .npz
+    tmp_path = cache_path[: -len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, signature=signature, **arrays)
+    os.replace(tmp_path, cache_path)
+    return arrays
+
+
+def load_correctness_matrix(report_paths: list[list[str]]) -> tuple[np.ndarray, np.ndarray]:
+    """Stacks the reports of models x prompt types in a correctness matrix.
+
+    Args:
+        report_paths (list[list[str]]): the report of each model (rows) and prompt type (columns).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the correctness (models x prompt types x questions, bool)
+        and the area index of each question.
+    """
+    ids, areas, rows = None, None, []
+    for model_report_paths in report_paths:
+        row = []
+        for report_path in model_report_paths:
+            arrays = load_report_arrays(report_path)
+            if ids is None:
+                ids, areas = arrays["ids"], arrays["areas"]
+            elif not np.array_equal(arrays["ids"], ids):
+                raise ValueError(f"{report_path} does not have the same questions, in the same order, as the others")
+            row.append(arrays["correct"])
+        rows.append(row)
+    return np.array(rows, dtype=bool), areas
+
+
+def get_area_masks(areas: np.ndarray) -> np.ndarray:
+    """(areas + total) x questions, whether each question counts for each area"""
+    masks = areas[None, :] == np.arange(len(AREAS))[:, None]
+    return np.concatenate([masks, np.ones((1, len(areas)), dtype=bool)])
+
+
+def get_accuracy(correct: np.ndarray, areas: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """returns the number of correct answers (models x prompt types x (areas + total)) and of questions of each area"""
+    masks = get_area_masks(areas).astype(np.int64)
+    return correct.astype(np.int64) @ masks.T, masks.sum(axis=1)
+
+
+def load_report_accuracies(report_paths: list[list[str]]) -> tuple[np.ndarray, np.ndarray]:
+    """Counts the correct answers and the questions of each report by area. Unlike load_correctness_matrix, the
+    reports may have different questions, e.g., a partial or resumed run.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the number of correct answers and of questions, both
+        models x prompt types x (areas + total).
+    """
+    is_correct_by_area, count_by_area = [], []
+    for model_report_paths in report_paths:
+        is_correct_row, count_row = [], []
+        for report_path in model_report_paths:
+            arrays = load_report_arrays(report_path)
+            is_correct, count = get_accuracy(arrays["correct"][None, None, :], arrays["areas"])
+            is_correct_row.append(is_correct[0, 0])
+            count_row.append(count)
+        is_correct_by_area.append(is_correct_row)
+        count_by_area.append(count_row)
+    return np.array(is_correct_by_area, dtype=np.int64), np.array(count_by_area, dtype=np.int64)
+
+
+def get_bootstrap_intervals(
+    correct: np.ndarray, areas: np.ndarray, n_bootstrap: int = 10000, confidence: float = 0.95, seed: int = 0
+) -> np.ndarray:
+    """Percentile bootstrap confidence intervals of the accuracies.
+
+    The questions are resampled with replacement within each area (and among all of them for the total).
+    The same resamples are used for every model and prompt type, so the intervals are comparable.
+
+    Returns:
+        np.ndarray: models x prompt types x (areas + total) x 2 (lower and upper bounds).
+    """
+    rng = np.random.default_rng(seed)
+    intervals = np.empty(correct.shape[:2] + (len(AREAS) + 1, 2))
+    quantiles = [(1 - confidence) / 2, 1 - (1 - confidence) / 2]
+    for area_index, mask in enumerate(get_area_masks(areas)):
+        question_indexes = np.flatnonzero(mask)
+        if len(question_indexes) == 0:
+            intervals[:, :, area_index] = np.nan
+            continue
+        resamples = question_indexes[rng.integers(0, len(question_indexes), size=(n_bootstrap, len(question_indexes)))]
+        # models x prompt types x n_bootstrap
+        accuracies = correct[:, :, resamples].sum(axis=-1, dtype=np.int32) / len(question_indexes)
+        intervals[:, :, area_index] = np.moveaxis(np.quantile(accuracies, quantiles, axis=-1), 0, -1)
+    return intervals
+
+
+def get_stratified_order(areas: np.ndarray, seed: int = 0) -> np.ndarray:
+    """A random order of the questions in which the areas keep about the proportions of the whole dataset.
+
+    The questions of each area are shuffled and spread evenly (with a random offset) over the order, so any prefix
+    is a stratified sample of the questions.
+    """
+    rng = np.random.default_rng(seed)
+    keys = np.empty(len(areas))
+    for area_index in range(len(AREAS)):
+        question_indexes = rng.permutation(np.flatnonzero(areas == area_index))
+        keys[question_indexes] = (np.arange(len(question_indexes)) + rng.random()) / max(1, len(question_indexes))
+    return np.argsort(keys, kind="stable")
+
+
+def get_stratified_interval(
+    values: np.ndarray,
+    areas: np.ndarray,
+    answered: np.ndarray,
+    confidence: float = 0.95,
+    bounds: tuple[float, float] = (0.0, 1.0),
+) -> tuple[float, float, float]:
+    """Normal confidence interval of the mean of values over all the questions, from the answered ones.
+
+    The answered questions are taken as a stratified sample by area (see get_stratified_order): the mean of each area
+    is weighted by its share of the questions, and the variance has the finite population correction, so the width
+    is 0 once every question is answered. Each area gets a pseudo-observation at each of the bounds of the values,
+    so a run of identical values (e.g., only correct answers) at the start does not give a zero width.
+
+    Args:
+        values (np.ndarray): per question, e.g., whether the answer is correct, or the paired difference with another
+            report (-1, 0 or 1, with bounds (-1, 1)).
+        areas (np.ndarray): the area index of each question (see AREAS).
+        answered (np.ndarray): whether each question was answered, the values of the others are ignored.
+
+    Returns:
+        tuple[float, float, float]: the estimate and the lower and upper bounds, infinite while an area has no answer.
+    """
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    estimate, variance = 0.0, 0.0
+    for area_index in range(len(AREAS)):
+        mask = areas == area_index
+        n_questions = mask.sum()
+        if n_questions == 0:
+            continue
+        area_values = values[mask & answered]
+        if len(area_values) == 0:
+            return np.nan, -np.inf, np.inf
+        weight = n_questions / len(areas)
+        estimate += weight * area_values.mean()
+        smoothed_variance = np.concatenate([area_values, bounds]).var(ddof=1)
+        variance += weight**2 * smoothed_variance / len(area_values) * (1 - len(area_values) / n_questions)
+    margin = z * np.sqrt(variance)
+    return float(estimate), float(estimate - margin), float(estimate + margin)
@@ -1,20 +1,40 @@
 import os
+import copy
+import uuid
+import hashlib
+import contextvars
+import threading
 import traceback
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from chat_completion_wrapper import (
     OpenAIChatCompletionWrapper,
     MariTalkChatCompletionWrapper,
     LoadingModelError,
     DisabledEndpointError,
     AuthenticationError,
+    ChatMessage,
+    RequestCoalescer,
 )
 from prompt_builder import get_prompt
-from logger import logger
-from evaluator import get_dataset, get_formatted_answer
+from logger import logger, log_session
+from evaluator import DATASET_TO_FILENAME, get_dataset, get_formatted_answer
 
 LOG_STDOUT = True
 ENABLE_DOWNLOAD_LOG = True
 
+# the wrappers (and the validation of their API key) are shared by the sessions for a while
+LLM_CACHE_TTL = 60 * 60  # seconds
+LLM_CACHE_MAX_ENTRIES = 256
+
+# answers to the Enem 2022 questions kept for all the sessions (3 prompt types x 3 models x ~180 questions)
+ANSWER_CACHE_MAX_ENTRIES = 2048
+ANSWER_CACHE_MAX_AGE = 24 * 60 * 60  # seconds
+
+# questions answered at the same time in the bulk mode
+DEFAULT_BULK_CONCURRENCY = 8
+MAX_BULK_CONCURRENCY = 16
+
 
 st.set_page_config(page_title="LLM Enem", layout="wide")
 
@@ -57,14 +77,50 @@ def get_input_source_option():
     return question
 
 
+def get_prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).digest()
+
+
+@st.cache_resource
+def get_request_coalescer():
+    """shared by all the sessions: identical requests in flight are sent once (whatever the input source), and the
+    answers to the Enem 2022 questions are kept, the custom questions are not"""
+    dataset_prompt_hashes = {
+        get_prompt_hash(question["prompt"])
+        for dataset_name in DATASET_TO_FILENAME
+        for questions_by_area in get_cached_dataset(dataset_name).values()
+        for question in questions_by_area.values()
+    }
+
+    def is_dataset_question(messages: list[ChatMessage]) -> bool:
+        return len(messages) == 1 and get_prompt_hash(messages[0].content) in dataset_prompt_hashes
+
+    return RequestCoalescer(
+        max_entries=ANSWER_CACHE_MAX_ENTRIES, max_age=ANSWER_CACHE_MAX_AGE, cache_when=is_dataset_question
+    )
+
+
+@st.cache_resource(ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_cached_llm(model, api_key_hash, _api_key):
+    """one wrapper per model and API key, created (and the key checked) once. The key itself is not hashed by
+    streamlit (leading underscore), the wrappers are found by the hash of the key"""
+    if model == "MariTalk":
+        return MariTalkChatCompletionWrapper(cache=get_request_coalescer())
+    return OpenAIChatCompletionWrapper(model=model, openai_api_key=_api_key, cache=get_request_coalescer())
+
+
+def get_session_llm(model, api_key=None):
+    """a shallow copy of the cached wrapper, so each session has its own messages but shares the connections"""
+    api_key_hash = None if api_key is None else hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    return copy.copy(get_cached_llm(model, api_key_hash, api_key))
+
+
 def set_llm():
     if st.session_state["model"] in ["gpt-3.5-turbo", "gpt-4"]:
         try:
             if len(st.session_state["openai_api_key"]) == 0:
                 return
-            st.session_state["llm"] = OpenAIChatCompletionWrapper(
-                model=st.session_state["model"], openai_api_key=st.session_state["openai_api_key"]
-            )
+            st.session_state["llm"] = get_session_llm(st.session_state["model"], st.session_state["openai_api_key"])
             # print("set_llm(): ", st.session_state["model"])
         except AuthenticationError as e:
             st.error(
@@ -76,7 +132,7 @@ def set_llm():
         else:
             st.session_state["model_changed"] = False
     elif st.session_state["model"] == "MariTalk":
-        st.session_state["llm"] = MariTalkChatCompletionWrapper()
+        st.session_state["llm"] = get_session_llm("MariTalk")
         # print("set_llm(): ", st.session_state["model"])
         st.session_state["model_changed"] = False
     else:
@@ -86,13 +142,17 @@ def set_llm():
 def generate():
     question = get_input_source_option()
 
+    st.divider()
+    st.subheader("Answer")
+    answer_placeholder = st.empty()
+
     with st.spinner("Generating answer..."):
         st.session_state["llm"].new_session()
-        answer = st.session_state["llm"](question["prompt"])
+        # the answer is shown as it is generated (MariTalk has no streaming, and the answers already given or being
+        # generated for another session are shown at the end)
+        answer = st.session_state["llm"](question["prompt"], on_text=answer_placeholder.markdown)
 
-    st.divider()
-    st.subheader("Answer")
-    st.markdown(answer)
+    answer_placeholder.markdown(answer)
 
     if st.session_state["input_source"] == "Enem 2022":
         pred, gold = get_formatted_answer(question, answer)
@@ -106,7 +166,94 @@ def generate():
             st.markdown(f"The expected answer is:\n\n{gold} {question['choices'][question['gold']]}")
 
     with st.expander("Data details"):
-        st.json(question)
+        st.json(dict(question))
+
+
+def answer_bulk_question(llm, question, cancelled: threading.Event):
+    """runs in a worker thread of the bulk mode, returns None if the bulk mode was stopped before it started"""
+    if cancelled.is_set():
+        return None
+    llm = copy.copy(llm)  # its own messages, the worker threads share the wrapper of the session
+    llm.log = False  # the session log would mix the questions answered at the same time
+    llm.new_session()
+    answer = llm(question["prompt"])
+    pred, gold = get_formatted_answer(question, answer)
+    return dict(id=question["id"], pred=pred, gold=gold, correct=pred == gold)
+
+
+def get_bulk_table(results):
+    rows = [dict(area) for area in results.values()]
+    rows.append(
+        dict(
+            Area="All",
+            **{column: sum(row[column] for row in rows) for column in ["Answered", "Correct", "Errors", "Total"]},
+        )
+    )
+    for row in rows:
+        row["Accuracy"] = f"{row['Correct'] / row['Answered']:.1%}" if row["Answered"] > 0 else "-"
+    return rows
+
+
+def generate_bulk():
+    """answers all the questions of the selected area (or of all areas) concurrently, showing the accuracy so far"""
+    dataset = st.session_state["dataset"]
+    if st.session_state["bulk_all_areas"]:
+        areas = list(dataset.keys())
+    else:
+        areas = [st.session_state["selected_question_area"]]
+
+    st.divider()
+    st.subheader("Answers")
+    # clicking it (or any other widget) reruns the script, interrupting the loop below at its next streamlit call
+    st.button("Stop", key="bulk_stop")
+    progress_bar = st.progress(0.0)
+    table = st.empty()
+
+    results = {area: dict(Area=area, Answered=0, Correct=0, Errors=0, Total=len(dataset[area])) for area in areas}
+    st.session_state["bulk_results"] = results
+    total = sum(len(dataset[area]) for area in areas)
+    done = 0
+    errors = []
+    items = []
+
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=st.session_state["bulk_concurrency"])
+    try:
+        futures = {
+            # in the context of the script, so the messages go to the log of this session
+            executor.submit(
+                contextvars.copy_context().run, answer_bulk_question, st.session_state["llm"], question, cancelled
+            ): area
+            for area in areas
+            for question in dataset[area].values()
+        }
+        pending = set(futures)
+        while len(pending) > 0:
+            finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in finished:
+                area = futures[future]
+                done += 1
+                try:
+                    item = future.result()
+                except Exception as e:
+                    results[area]["Errors"] += 1
+                    errors.append(e)
+                    continue
+                results[area]["Answered"] += 1
+                results[area]["Correct"] += item["correct"]
+                items.append(dict(area=area, **item))
+            progress_bar.progress(done / total, text=f"{done}/{total} questions")
+            table.table(get_bulk_table(results))
+    finally:
+        # stopped (or failed): the questions not started are dropped, the ones in flight finish in the background
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    st.session_state.pop("bulk_results", None)  # finished, nothing to show after a rerun
+    if len(errors) > 0:
+        st.warning(f"{len(errors)} questions failed, e.g., {type(errors[0]).__name__}: {errors[0]}", icon="⚠️")
+    with st.expander("Answers details"):
+        st.dataframe(sorted(items, key=lambda item: item["id"]))
 
 
 def model_changed():
@@ -114,7 +261,7 @@ def model_changed():
 
 
 def main():
-    if len(st.session_state) == 0:
+    if "llm" not in st.session_state:
         st.session_state["dataset"] = None
         st.session_state["llm"] = None
         st.session_state["model_changed"] = True
@@ -155,6 +302,7 @@ def main():
             on_change=set_dataset,
         )
 
+        answer_bulk = False
         if st.session_state["input_source"] == "Enem 2022":
             if st.session_state["dataset"] == None:
                 set_dataset()
@@ -173,6 +321,21 @@ def main():
                 key="selected_question",
             )
 
+            with st.expander("Bulk mode"):
+                st.checkbox("All areas", key="bulk_all_areas", help="Answer the questions of every area.")
+                st.number_input(
+                    "Parallel requests",
+                    min_value=1,
+                    max_value=MAX_BULK_CONCURRENCY,
+                    value=DEFAULT_BULK_CONCURRENCY,
+                    key="bulk_concurrency",
+                )
+                answer_bulk = st.button(
+                    "Answer the whole area",
+                    disabled=st.session_state["model_changed"],
+                    help="Answers all the questions of the selected area (or of all areas) and shows the accuracy.",
+                )
+
         if st.button("Answer", disabled=st.session_state["model_changed"]):
             try:
                 generate()
@@ -190,13 +353,21 @@ def main():
 
             if ENABLE_DOWNLOAD_LOG:
                 st.divider()
-                with open(log_filepath, "r", encoding="utf-8") as f:
-                    st.download_button(
-                        label="Download Session Log",
-                        data=f,
-                        file_name=os.path.basename(log_filepath),
-                        mime="text/plain",
-                    )
+                # the log is stored as jsonl, the HTML is only rendered for the download
+                st.download_button(
+                    label="Download Session Log",
+                    data=logger.render_html(log_filepath),
+                    file_name=os.path.splitext(os.path.basename(log_filepath))[0] + ".html",
+                    mime="text/html",
+                )
+
+        if answer_bulk:
+            generate_bulk()
+        elif st.session_state.get("bulk_stop") and "bulk_results" in st.session_state:
+            # the rerun after Stop, the accuracy of the questions answered until then
+            st.divider()
+            st.subheader("Answers (stopped)")
+            st.table(get_bulk_table(st.session_state.pop("bulk_results")))
 
     with col1:
         if st.session_state["input_source"] == "Enem 2022":
@@ -228,9 +399,13 @@ def main():
 
 
 if __name__ == "__main__":
-    try:
-        main()
-    except BaseException:
-        logger(observation="ERROR", content=traceback.format_exc())
-        logger.save()
-        st.error("Internal Error! (if it persists, please contact viniciusferracoarruda@gmail.com)", icon="🚨")
+    # the wrappers are shared by the sessions, but each session has its own log file
+    if "log_session_id" not in st.session_state:
+        st.session_state["log_session_id"] = str(uuid.uuid4())
+    with log_session(st.session_state["log_session_id"]):
+        try:
+            main()
+        except BaseException:
+            logger(observation="ERROR", content=traceback.format_exc())
+            logger.save()
+            st.error("Internal Error! (if it persists, please contact viniciusferracoarruda@gmail.com)", icon="🚨")